@@ -1,13 +1,33 @@
 #!/usr/bin/python
 from __future__ import print_function
 
-__all__ = ['Fusion', 'FusionCollection', 'FusionError', 'FusionRequester', 'HttpFusionRequester']
+__all__ = ['Fusion', 'FusionCollection', 'FusionError', 'FusionRequester', 'HttpFusionRequester',
+           'AsyncHttpFusionRequester', 'SingleFlightRequester', 'BalancedFusionRequester',
+           'CircuitOpenError']
+
+MAX_BODY_EXCERPT = 1024
+
+
+def body_excerpt(body, limit=MAX_BODY_EXCERPT):
+    """
+    :return: at most limit characters of a request body, for messages, or a placeholder if it can't be shown
+    """
+    if not isinstance(body, basestring):
+        return "(streamed request body)\n"
+    if len(body) > limit:
+        return "%s... (%d more bytes)\n" % (body[0:limit], len(body) - limit)
+    return body
+
 
 class FusionError(IOError):
+    # True when the request is known not to have reached Fusion, so it may be sent elsewhere whatever its method
+    unsent = False
+
     def __init__(self, response, request_body=None, message=None, url=None):
         """
         :param response: The HTTP response, having attributes .body and .status (or str or unicode)
-        :param request_body: The HTTP request body that percipitated this error
+        :param request_body: The HTTP request body that percipitated this error.  Only the first MAX_BODY_EXCERPT
+           characters are kept.
         :param message: Any text to go along with this
         :param url: The URL requested
         """
@@ -22,9 +42,26 @@ class FusionError(IOError):
             if url is not None:
                 message = "Requested " + url + "\n"
             if request_body is not None:
-                message += request_body
+                message += body_excerpt(request_body)
             if response is not None:
                 message += "Status %d\n\n%s" % (response.status, response.data)
         IOError.__init__(self, message)
         self.response = response
         self.url = url
+
+
+class CircuitOpenError(FusionError):
+    """
+    Raised without making a request, because recent requests of the same kind have been failing.
+    """
+    unsent = True
+
+    def __init__(self, endpoint, retry_after):
+        """
+        :param endpoint: the class of endpoint whose circuit is open, as given by connectors.endpoint_class
+        :param retry_after: the seconds until a request will be let through to probe for recovery
+        """
+        FusionError.__init__(self, None, message="Fusion %s requests are failing; not trying again for %.1f seconds"
+                                                 % (endpoint, retry_after))
+        self.endpoint = endpoint
+        self.retry_after = retry_after
@@ -0,0 +1,292 @@
+from fusionpy import jsoncodec
+from fusionpy.connectors import HttpFusionRequester
+from fusionpy.fakefusion import FakeFusion, FakeFusionServer
+from fusionpy.fusion import Fusion
+from fusionpy.instrumentation import Instrumentation, RequestMetrics
+import gc
+import getopt
+import json
+import math
+import multiprocessing
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+"""
+Contains benchmarks of indexing, querying and configuration against a fakefusion.FakeFusionServer, and a comparison
+of their results with a baseline, so that changes making fusionpy slower are noticed
+
+    python -m fusionpy.benchmark --output build/benchmark.json --baseline benchmarks/baseline.json
+"""
+
+INDEX_BATCH_SIZES = (100, 500, 2000)
+
+# What in the environment must match the baseline's for the timings to be comparable
+COMPARED_ENVIRONMENT = ("json", "python", "docs", "queries", "latency")
+
+# How much worse than the baseline a timing may be before it is a regression, allowing for a noisy machine.
+# Request counts must not grow at all.
+DEFAULT_TOLERANCE = 0.5
+
+CATEGORIES = ["c%d" % i for i in range(0, 10)]
+WORDS = ("fusion solr index query pipeline document field facet shard replica collection schema cursor batch "
+         "commit stream latency throughput").split()
+
+
+def documents(count, seed=0):
+    """
+    :return: a generator of count documents of a few hundred bytes each, the same for the same seed
+    """
+    r = random.Random(seed)
+    for i in range(0, count):
+        yield {"id": "doc%07d" % i,
+               "title": " ".join(r.choice(WORDS) for _ in range(0, 5)),
+               "body": " ".join(r.choice(WORDS) for _ in range(0, 40)),
+               "price": round(r.uniform(1, 1000), 2),
+               "category": r.choice(CATEGORIES),
+               "tags": r.sample(WORDS, 3),
+               "modified": "2016-%02d-%02dT00:00:00Z" % (r.randint(1, 12), r.randint(1, 28))}
+
+
+def percentile(sorted_values, q):
+    """
+    :return: the value at the q quantile (0 <= q <= 1) of the sorted values, by the nearest rank
+    """
+    return sorted_values[max(0, int(math.ceil(q * len(sorted_values))) - 1)]
+
+
+def metric(value, unit, better):
+    """
+    :param better: "higher" or "lower", whichever is an improvement
+    """
+    return {"value": value, "unit": unit, "better": better}
+
+
+def bench_index(collection, docs=10000, batch_sizes=INDEX_BATCH_SIZES, repeat=3):
+    """
+    Index docs documents with FusionCollection.index, batch_size at a time, for each batch size.
+
+    :return: the metrics, taking the best of repeat runs
+    """
+    results = {}
+    corpus = list(documents(docs))
+    for batch_size in batch_sizes:
+        best = 0
+        for _ in range(0, repeat):
+            started = time.time()
+            for i in range(0, docs, batch_size):
+                collection.index(corpus[i:i + batch_size])
+            best = max(best, docs / (time.time() - started))
+            collection.commit()
+        results["index.batch_%d.docs_per_second" % batch_size] = metric(round(best, 1), "docs/s", "higher")
+    return results
+
+
+def bench_queries(collection, queries=300, repeat=3, docs=1000):
+    """
+    Time queries through the pipeline and straight to Solr, without the result cache.  The collection is filled
+    with just docs documents, so that the time is mostly fusionpy's rather than the fake server's.
+
+    :return: latency percentiles of each, in milliseconds, taking the best of repeat runs of queries queries
+    """
+    collection.index(list(documents(docs)))
+    collection.commit()
+    results = {}
+    for name, query in (("query", collection.query), ("solrquery", collection.solrquery)):
+        best = {}
+        for attempt in range(-1, repeat):
+            r = random.Random(1)
+            latencies = []
+            # The first run only warms up
+            for i in range(0, queries if attempt >= 0 else queries / 10):
+                qparams = {"q": "category:%s" % r.choice(CATEGORIES), "rows": 10, "sort": "price desc"}
+                if i % 3 == 0:
+                    qparams.update({"facet": "true", "facet.field": "category"})
+                started = time.time()
+                query(qparams=qparams, use_cache=False)
+                latencies.append((time.time() - started) * 1000)
+            latencies.sort()
+            if attempt >= 0:
+                for q in (50, 90, 99):
+                    p = percentile(latencies, q / 100.0)
+                    best[q] = min(best.get(q, p), p)
+        for q, p in best.items():
+            results["%s.p%d_ms" % (name, q)] = metric(round(p, 3), "ms", "lower")
+    return results
+
+
+def realistic_config(files, suffix=""):
+    """
+    :param files: a directory to write the collection's Solr config files into
+    :param suffix: for the names of the collection and pipelines, so that the configuration can be created again
+    :return: parameters for Fusion.ensure_config: a collection with a couple dozen fields and a few field types,
+       features and config files, and a pair each of index and query pipelines
+    """
+    for name, content in (("synonyms.txt", "fast,quick\nbig,large\n" * 50),
+                          ("stopwords.txt", "\n".join(WORDS[0:10])),
+                          ("elevate.xml", "<elevate>%s</elevate>" % ("<query text='x'><doc id='1'/></query>" * 20))):
+        with open("%s/%s" % (files, name), "w") as fh:
+            fh.write(content)
+    field_types = [{"name": "text_%s" % lang, "class": "solr.TextField", "positionIncrementGap": "100",
+                    "analyzer": {"tokenizer": {"class": "solr.StandardTokenizerFactory"},
+                                 "filters": [{"class": "solr.LowerCaseFilterFactory"}]}}
+                   for lang in ("en", "de", "fr")]
+    fields = [{"name": "%s_%d" % (kind, i), "type": kind, "indexed": True, "stored": True}
+              for kind in ("string", "long", "text_en") for i in range(0, 8)]
+    stages = [{"type": "field-mapping", "id": "map"}, {"type": "solr-index", "id": "solr", "skip": False}]
+    return {"collections": {"bench" + suffix: {"collection": {"solrParams": {"numShards": 1, "replicationFactor": 1}},
+                                      "schema": {"fieldTypes": field_types, "fields": fields},
+                                      "files": files,
+                                      "features": {"signals": True, "searchLogs": True}}},
+            "indexPipelines": [{"id": "bench%s-%d" % (suffix, i), "stages": stages} for i in range(0, 2)],
+            "queryPipelines": [{"id": "bench%s-%d" % (suffix, i), "stages": [{"type": "solr-query", "id": "solr"}]}
+                               for i in range(0, 2)]}
+
+
+def bench_ensure_config(fusion, metrics, repeat=3):
+    """
+    Run Fusion.ensure_config on a realistic configuration twice: first to create it, then to find nothing to do.
+
+    :param metrics: the RequestMetrics of the requester of fusion, to count the requests
+    :return: the requests made and wall time of each run, taking the best of repeat configurations
+    """
+    files = tempfile.mkdtemp()
+    try:
+        results = {}
+        for attempt in range(0, repeat):
+            config = realistic_config(files, "-%d" % attempt)
+            for run in ("create", "unchanged"):
+                metrics.reset()
+                started = time.time()
+                if not fusion.ensure_config(**config):
+                    raise AssertionError("ensure_config did not finish configuring")
+                ms = round((time.time() - started) * 1000, 3)
+                requests = sum(series["count"] for series in metrics.as_dict())
+                results["ensure_config.%s.requests" % run] = metric(requests, "requests", "lower")
+                timing = "ensure_config.%s.ms" % run
+                if timing not in results or ms < results[timing]["value"]:
+                    results[timing] = metric(ms, "ms", "lower")
+        return results
+    finally:
+        shutil.rmtree(files)
+
+
+def _serve(urls, latency):
+    gc.disable()
+    server = FakeFusionServer(fusion=FakeFusion(collections=("index", "query")), latency=latency)
+    urls.put(server.collection_url("index"))
+    server.serve_forever()
+
+
+def run(docs=10000, batch_sizes=INDEX_BATCH_SIZES, queries=300, repeat=3, latency=0.0):
+    """
+    Run all the benchmarks against a new FakeFusionServer.  The server runs in another process, so that it doesn't
+    contend with fusionpy for the interpreter lock.  Only ensure_config, whose requests are counted, is run with
+    instrumentation, so that the hooks don't land in the timings of indexing and querying.
+
+    :param latency: seconds the server takes over each response
+    :return: a dict of the environment and the metrics
+    """
+    urls = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_serve, args=(urls, latency), name="fake-fusion")
+    server.daemon = True
+    server.start()
+    # As timeit does, so that collections of the corpus don't land in the timings
+    gc.disable()
+    try:
+        url = urls.get(timeout=30)
+        fusion = Fusion(HttpFusionRequester(url))
+        results = bench_index(fusion.get_collection("index"), docs, batch_sizes, repeat)
+        results.update(bench_queries(fusion.get_collection("query"), queries, repeat))
+        metrics = RequestMetrics()
+        counted = Fusion(HttpFusionRequester(url, instrumentation=Instrumentation(after=[metrics])))
+        results.update(bench_ensure_config(counted, metrics, repeat * 3))
+    finally:
+        gc.enable()
+        server.terminate()
+        server.join()
+    return {"environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "json": jsoncodec.backend, "docs": docs, "queries": queries, "latency": latency,
+                            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())},
+            "metrics": results}
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    :param results: the output of run()
+    :param baseline: the output of an earlier run()
+    :param tolerance: the fraction by which a timing may be worse than its baseline
+    :return: a list of (name, baseline value, value, change as a fraction, True if it is a regression) for the
+       metrics in both
+    """
+    comparison = []
+    for name, m in sorted(results["metrics"].items()):
+        base = baseline["metrics"].get(name)
+        if base is None:
+            continue
+        value, base_value = m["value"], base["value"]
+        change = (value - base_value) / float(base_value) if base_value else 0.0
+        worse = -change if m["better"] == "higher" else change
+        allowed = 0 if m["unit"] == "requests" else tolerance
+        comparison.append((name, base_value, value, change, worse > allowed))
+    return comparison
+
+
+def compare_environment(results, baseline):
+    """
+    :param results: the output of run()
+    :param baseline: the output of an earlier run()
+    :return: a list of (name, baseline value, value) for each COMPARED_ENVIRONMENT setting that differs
+    """
+    return [(name, baseline["environment"].get(name), results["environment"].get(name))
+            for name in COMPARED_ENVIRONMENT
+            if baseline["environment"].get(name) != results["environment"].get(name)]
+
+
+def main(args):
+    """
+    :param args: [--output file] [--baseline file] [--tolerance fraction] [--docs n] [--queries n] [--repeat n]
+       [--latency seconds]
+    :return: 1 if a metric regressed from the baseline, 2 if the baseline was run in a different environment, so
+       that the timings can't be compared, 0 otherwise
+    """
+    opts, _ = getopt.getopt(args, "", ["output=", "baseline=", "tolerance=", "docs=", "queries=", "repeat=",
+                                       "latency="])
+    opts = dict(opts)
+    results = run(docs=int(opts.get("--docs", 10000)), queries=int(opts.get("--queries", 300)),
+                  repeat=int(opts.get("--repeat", 3)), latency=float(opts.get("--latency", 0)))
+    if "--output" in opts:
+        with open(opts["--output"], "w") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True, separators=(',', ': '))
+            fh.write("\n")
+
+    if "--baseline" not in opts:
+        for name, m in sorted(results["metrics"].items()):
+            print "%-40s %12s %s" % (name, m["value"], m["unit"])
+        return 0
+
+    with open(opts["--baseline"]) as fh:
+        baseline = json.load(fh)
+    mismatches = compare_environment(results, baseline)
+    for name, base_value, value in mismatches:
+        print "Environment differs from %s: %s was %s, is %s" % (opts["--baseline"], name, base_value, value)
+    regressions = 0
+    for name, base_value, value, change, regressed in compare(results, baseline,
+                                                              float(opts.get("--tolerance", DEFAULT_TOLERANCE))):
+        print "%-40s %12s %12s %+7.1f%%%s" % (name, base_value, value, change * 100,
+                                              "  REGRESSION" if regressed else "")
+        regressions += regressed
+    if regressions:
+        print "%d metrics regressed from %s" % (regressions, opts["--baseline"])
+        return 1
+    if mismatches:
+        print "Record a baseline in this environment to compare with"
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+
+"""
+Contains caches for query results
+"""
+
+
+def result_key(collection, qurl, handler, qparams):
+    """
+    :return: a key identifying a query, regardless of the order of its parameters.  The first element is the
+       collection name, for invalidation.
+    """
+    params = []
+    for k, v in qparams.items():
+        if isinstance(v, (list, tuple)):
+            v = tuple(v)
+        params.append((k, v))
+    return collection, qurl, handler, tuple(sorted(params))
+
+
+class ResultCache(object):
+    """
+    A least-recently-used cache of query responses whose entries also expire after a time to live.  Safe to share
+    among threads and among collections.  Any object with the methods get, put, and invalidate can stand in for it,
+    taking keys made by result_key.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60.0, clock=time.time):
+        """
+        :param max_entries: the most responses to keep, evicting the least recently used beyond that
+        :param ttl: the seconds a response stays fresh, or None to keep it until evicted or invalidated
+        :param clock: the function telling the time
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        :return: the cached value, or None if there is none or it has expired
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or (self.ttl is not None and self.clock() - entry[0] > self.ttl):
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (self.clock(), value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, collection=None):
+        """
+        Forget the results for one collection, or for all collections if none is named.
+        """
+        with self._lock:
+            if collection is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == collection]:
+                    del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
@@ -0,0 +1,265 @@
+import array
+import calendar
+import re
+import time
+from collections import OrderedDict
+
+from fusionpy.jsonstream import DocsStreamParser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+Contains the materialization of query responses as columns, for vectorized analysis
+"""
+
+TYPES = ('int', 'float', 'date', 'str', 'object')
+
+SOLR_DATE = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?Z$')
+
+
+def infer_type(values):
+    """
+    :param values: the values of one field, None where a document lacks it
+    :return: the narrowest of TYPES holding all the values
+    """
+    kind = None
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, (int, long)):
+            t = 'int'
+        elif isinstance(v, float):
+            t = 'float'
+        elif isinstance(v, basestring):
+            t = 'date' if SOLR_DATE.match(v) else 'str'
+        else:
+            return 'object'
+        if kind is None or kind == t:
+            kind = t
+        elif set([kind, t]) == set(['int', 'float']):
+            kind = 'float'
+        elif set([kind, t]) == set(['date', 'str']):
+            kind = 'str'
+        else:
+            return 'object'
+    return kind or 'str'
+
+
+def date_millis(value):
+    """
+    :param value: a Solr date, like 2017-03-01T12:00:00.250Z
+    :return: milliseconds since the epoch, as a float
+    """
+    m = SOLR_DATE.match(value)
+    if m is None:
+        raise ValueError("Not a Solr date: %r" % value)
+    millis = calendar.timegm(time.strptime(m.group(1), "%Y-%m-%dT%H:%M:%S")) * 1000.0
+    if m.group(2):
+        millis += round(float(m.group(2)) * 1000)
+    return millis
+
+
+class StringColumn(object):
+    """
+    Strings held end to end in one buffer, with the offsets where each ends, rather than as an object apiece.
+    Indexing and iterating give back the strings, or None where a document lacked the field.
+    """
+
+    def __init__(self, values):
+        values = list(values)
+        self.text = u''.join(v for v in values if v is not None)
+        self.ends = array.array('l')
+        self.nulls = None
+        end = 0
+        for i, v in enumerate(values):
+            if v is None:
+                if self.nulls is None:
+                    self.nulls = array.array('b', [0] * len(values))
+                self.nulls[i] = 1
+            else:
+                end += len(v)
+            self.ends.append(end)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if self.nulls is not None and self.nulls[i]:
+            return None
+        return self.text[self.ends[i - 1] if i > 0 else 0:self.ends[i]]
+
+    def __iter__(self):
+        for i in range(0, len(self)):
+            yield self[i]
+
+    def tolist(self):
+        return list(self)
+
+    def __repr__(self):
+        return "StringColumn(%r)" % self.tolist()
+
+
+def column(values, kind):
+    """
+    Pack the values of one field into an array.  With NumPy, numbers are int64 or float64 and dates are
+    datetime64[ms]; without it, they are array.array of longs or doubles, dates in milliseconds since the epoch.
+    A missing number or date is NaN (or NaT), making an int column float.
+
+    :param values: the values of one field, None where a document lacks it
+    :param kind: one of TYPES
+    :return: the column
+    """
+    if kind == 'str':
+        return StringColumn(None if v is None else unicode(v) for v in values)
+    if kind == 'object':
+        return list(values)
+    missing = any(v is None for v in values)
+    if kind == 'date':
+        if numpy is not None:
+            return numpy.array(['NaT' if v is None else SOLR_DATE.match(v).group(0)[:-1] for v in values],
+                               dtype='datetime64[ms]')
+        return array.array('d', (float('nan') if v is None else date_millis(v) for v in values))
+    if kind == 'int' and not missing:
+        if numpy is not None:
+            return numpy.array(values, dtype=numpy.int64)
+        return array.array('l', values)
+    if kind in ('int', 'float'):
+        if numpy is not None:
+            return numpy.array([numpy.nan if v is None else v for v in values], dtype=numpy.float64)
+        return array.array('d', (float('nan') if v is None else v for v in values))
+    raise ValueError("Unknown column type %s" % kind)
+
+
+class FacetCounts(object):
+    """
+    The buckets of one facet, as a column of values and a column of their counts.  Iterating gives (value, count)
+    pairs in the order Solr returned them.
+    """
+
+    def __init__(self, values, counts):
+        self.values = column(values, infer_type(values))
+        self.counts = column(counts, 'int')
+
+    @staticmethod
+    def parse(buckets):
+        """
+        :param buckets: a facet as Solr renders it, as a flat list alternating value and count (json.nl=flat, the
+           default), a list of pairs (json.nl=arrarr), or a dict (json.nl=map)
+        """
+        if isinstance(buckets, dict):
+            pairs = buckets.items()
+        elif buckets and isinstance(buckets[0], list):
+            pairs = buckets
+        else:
+            pairs = zip(buckets[0::2], buckets[1::2])
+        return FacetCounts([p[0] for p in pairs], [p[1] for p in pairs])
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        for i in range(0, len(self)):
+            yield self.values[i], self.counts[i]
+
+    def pairs(self):
+        return list(self)
+
+    def __repr__(self):
+        return "FacetCounts(%r)" % self.pairs()
+
+
+def collect_values(docs, fl):
+    """
+    :param docs: an iterable of documents
+    :param fl: the names of the fields to collect
+    :return: (a dict of field name to the list of its values, None where a document lacks it; the number of
+       documents)
+    """
+    values = dict((field, []) for field in fl)
+    rows = 0
+    for doc in docs:
+        for field in fl:
+            values[field].append(doc.get(field))
+        rows += 1
+    return values, rows
+
+
+class ColumnarResult(object):
+    """
+    The documents of a query response as one column per field, along with its facet counts.
+    """
+
+    def __init__(self, response, fl, types=None, field_values=None):
+        """
+        :param response: the decoded json of a query response
+        :param fl: the names of the fields to make columns of
+        :param types: if specified, a dict of field name to one of TYPES, for fields whose type shouldn't be inferred
+           from the values
+        :param field_values: if the documents have already been taken out of the response, the
+           (dict of field name to list of values, number of documents) that collect_values() made of them
+        """
+        body = response.get("response", {})
+        if field_values is None:
+            field_values = collect_values(body.get("docs", []), fl)
+        values, self.rows = field_values
+        self.num_found = body.get("numFound", self.rows)
+        self.types = OrderedDict()
+        self.columns = OrderedDict()
+        for field in fl:
+            kind = (types or {}).get(field) or infer_type(values[field])
+            self.types[field] = kind
+            self.columns[field] = column(values[field], kind)
+            values[field] = None
+        counts = response.get("facet_counts", {})
+        self.facets = OrderedDict((field, FacetCounts.parse(buckets))
+                                  for field, buckets in counts.get("facet_fields", {}).items())
+        self.facet_queries = FacetCounts.parse(counts.get("facet_queries", {}))
+
+    @classmethod
+    def parse(cls, data, fl, types=None, chunk_size=65536):
+        """
+        Decode a query response straight into columns, one document at a time, so that the documents are never all
+        held as dicts at once.
+
+        :param data: the body of a query response, as bytes
+        :param fl: the names of the fields to make columns of
+        :param types: as for ColumnarResult()
+        :param chunk_size: how much of the body to decode to text at once
+        :return: a ColumnarResult
+        """
+        parser = DocsStreamParser((data[i:i + chunk_size] for i in xrange(0, len(data), chunk_size)),
+                                  outside=True)
+        field_values = collect_values(parser, fl)
+        return cls(parser.outside(), fl, types, field_values)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def __contains__(self, field):
+        return field in self.columns
+
+    def __repr__(self):
+        return "ColumnarResult(rows=%d, num_found=%d, types=%r)" % (self.rows, self.num_found, dict(self.types))
+
+
+def field_list(fl):
+    """
+    :param fl: field names, as a list or a comma separated string
+    :return: the list of field names
+    """
+    if isinstance(fl, basestring):
+        fl = [f.strip() for f in fl.split(",")]
+    fl = [f for f in fl if f]
+    if not fl or any("*" in f for f in fl):
+        raise ValueError("Name the fields for columns explicitly, not with wildcards")
+    return fl
@@ -0,0 +1,605 @@
+import copy
+import gzip
+import json
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from base64 import b64decode
+from collections import OrderedDict, defaultdict
+from io import BytesIO
+from urlparse import urlparse, parse_qs
+from fusionpy.instrumentation import path_template
+
+"""
+Contains a stand-in for the parts of the Fusion API that fusionpy uses, keeping everything in memory, for load
+testing fusionpy without Fusion or a network
+"""
+
+DEFAULT_SCHEMA = {
+    "name": "fake", "version": 1.5, "uniqueKey": "id",
+    "fieldTypes": [{"name": "string", "class": "solr.StrField", "sortMissingLast": True},
+                   {"name": "long", "class": "solr.TrieLongField", "precisionStep": "0", "positionIncrementGap": "0"},
+                   {"name": "text_general", "class": "solr.TextField", "positionIncrementGap": "100"}],
+    "fields": [{"name": "id", "type": "string", "indexed": True, "stored": True, "required": True},
+               {"name": "_version_", "type": "long", "indexed": True, "stored": True}]
+}
+
+DEFAULT_INDEX_PIPELINES = [{"id": "default", "stages": [{"type": "solr-index", "id": "solr", "skip": False}]}]
+
+DEFAULT_QUERY_PIPELINES = [{"id": "default", "stages": [{"type": "solr-query", "id": "solr", "skip": False}]}]
+
+# Solr config files every collection starts with
+DEFAULT_FILES = ("solrconfig.xml", "stopwords.txt", "synonyms.txt")
+
+# Responses at least this long are gzipped for clients that accept it
+GZIP_THRESHOLD = 1024
+
+
+class _JsonObject(dict):
+    """
+    A decoded json object that also keeps its members in order in pairs, repeated keys included, as Solr reads them
+    """
+
+
+def _json_object(pairs):
+    obj = _JsonObject(pairs)
+    obj.pairs = pairs
+    return obj
+
+
+class FakeError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class FakeCollection(object):
+    """
+    A collection in a FakeFusion: its documents, schema, Solr config files and features.
+    """
+
+    def __init__(self, name, config=None):
+        self.name = name
+        self.config = {"id": name, "solrParams": {"numShards": 1, "replicationFactor": 1}}
+        self.config.update(config or {})
+        self.docs = OrderedDict()
+        self.pending = OrderedDict()
+        self.schema = copy.deepcopy(DEFAULT_SCHEMA)
+        self.files = dict((f, ("application/xml" if f.endswith(".xml") else "text/plain", "", 0))
+                          for f in DEFAULT_FILES)
+        self.features = {"signals": False, "searchLogs": False}
+
+    def add(self, docs):
+        for doc in docs:
+            if "id" not in doc:
+                doc["id"] = str(uuid.uuid4())
+            self.pending[doc["id"]] = doc
+
+    def delete(self, ids):
+        for i in ids:
+            self.pending[i] = None
+
+    def commit(self):
+        for i, doc in self.pending.iteritems():
+            if doc is None:
+                self.docs.pop(i, None)
+            else:
+                self.docs[i] = doc
+        self.pending.clear()
+
+
+def _values(doc, field):
+    value = doc.get(field)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _term(value):
+    return value.strip().strip('"')
+
+
+def matcher(q):
+    """
+    :param q: a query in the little of the Solr syntax that FakeFusion understands: *:*, field:value,
+       field:* or a bare term, joined with OR, each optionally in parentheses
+    :return: a function taking a document and returning True if it matches
+    """
+    clauses = []
+    for clause in re.split(r'\s+OR\s+', (q or "*:*").strip()):
+        clause = clause.strip()
+        while clause.startswith('(') and clause.endswith(')'):
+            clause = clause[1:-1].strip()
+        if clause in ("*:*", "*", ""):
+            return lambda doc: True
+        field, colon, value = clause.partition(':')
+        if colon:
+            clauses.append((field.strip(), _term(value)))
+        else:
+            clauses.append((None, _term(clause).lower()))
+
+    def matches(doc):
+        for field, value in clauses:
+            if field is None:
+                if any(value in unicode(v).lower() for vs in doc.values() for v in (vs if isinstance(vs, list)
+                                                                                      else [vs])):
+                    return True
+            elif value == "*":
+                if _values(doc, field):
+                    return True
+            elif value in [unicode(v) for v in _values(doc, field)]:
+                return True
+        return False
+
+    return matches
+
+
+def _sort_fields(sort):
+    """
+    :return: a list of (field, True if descending) from a Solr sort parameter, like "price desc,id asc"
+    """
+    keys = []
+    for part in sort.split(','):
+        field, _, direction = part.strip().partition(' ')
+        keys.append((field, direction.strip().lower() == "desc"))
+    return keys
+
+
+def search(docs, params):
+    """
+    :param docs: the documents of the collection
+    :param params: the query parameters, as parse_qs returns them
+    :return: the Solr response, supporting q, fq, start, rows, fl, sort, cursorMark and facet.field
+    """
+    p = dict((k, v[-1]) for k, v in params.items())
+    match = matcher(p.get("q"))
+    filters = [matcher(fq) for fq in params.get("fq", [])]
+    found = [d for d in docs if match(d) and all(f(d) for f in filters)]
+    for field, descending in reversed(_sort_fields(p.get("sort", ""))):
+        if field:
+            # Documents without the field sort last whichever the direction
+            present = [d for d in found if field in d]
+            present.sort(key=lambda d: d[field], reverse=descending)
+            found = present + [d for d in found if field not in d]
+
+    rows = int(p.get("rows", 10))
+    mark = p.get("cursorMark")
+    start = int(p.get("start", 0)) if mark is None else (0 if mark == "*" else int(mark))
+    page = found[start:start + rows]
+    fl = [f.strip() for f in p.get("fl", "*").split(',')]
+    if "*" not in fl:
+        page = [dict((k, v) for k, v in d.items() if k in fl) for d in page]
+
+    result = {"responseHeader": {"status": 0, "QTime": 0, "params": p},
+              "response": {"numFound": len(found), "start": start, "docs": page}}
+    if mark is not None:
+        result["nextCursorMark"] = str(start + len(page)) if page else mark
+    if p.get("facet") == "true":
+        fields = {}
+        for field in params.get("facet.field", []):
+            counts = defaultdict(int)
+            for d in found:
+                for v in _values(d, field):
+                    counts[v] += 1
+            flat = []
+            for value, count in sorted(counts.items(), key=lambda vc: (-vc[1], vc[0])):
+                flat.extend([value, count])
+            fields[field] = flat
+        result["facet_counts"] = {"facet_queries": {}, "facet_fields": fields}
+    return result
+
+
+class FakeFusion(object):
+    """
+    The state of a fake Fusion: its admin password, collections and pipelines.  Requests are answered by
+    handle(), which FakeFusionServer calls for each HTTP request.
+    """
+
+    def __init__(self, password="password123", initialized=True, collections=("phi",)):
+        """
+        :param password: the admin password
+        :param initialized: False for a Fusion whose admin password has yet to be set
+        :param collections: the names of the collections to start with
+        """
+        self.password = password
+        self.initialized = initialized
+        self.collections = dict((c, FakeCollection(c)) for c in collections)
+        self.pipelines = {"index": OrderedDict((p["id"], p) for p in copy.deepcopy(DEFAULT_INDEX_PIPELINES)),
+                          "query": OrderedDict((p["id"], p) for p in copy.deepcopy(DEFAULT_QUERY_PIPELINES))}
+        self.lock = threading.RLock()
+
+    def collection(self, name):
+        c = self.collections.get(name)
+        if c is None:
+            raise FakeError(404, "Collection %s not found" % name)
+        return c
+
+    def authorized(self, authorization):
+        if not self.initialized:
+            return True
+        if not authorization or not authorization.startswith("Basic "):
+            return False
+        return b64decode(authorization[6:]).partition(':')[2] == self.password
+
+    def handle(self, method, path, params, body, content_type=None):
+        """
+        :param method: the HTTP method
+        :param path: the path of the request, without its query
+        :param params: the query parameters, as parse_qs returns them
+        :param body: the request body, decompressed and unchunked
+        :param content_type: the Content-Type of the body
+        :return: status, content type, and the response, which is encoded as json unless it is a string
+        """
+        with self.lock:
+            if path in ("/api", "/api/"):
+                return self.__api(method, body)
+            if not path.startswith("/api/apollo/"):
+                raise FakeError(404, "No such path %s" % path)
+            segments = path[len("/api/apollo/"):].rstrip('/').split('/')
+            kind = segments[0]
+            if kind == "collections":
+                return self.__collections(method, segments[1:], params, body, content_type)
+            if kind in ("index-pipelines", "query-pipelines"):
+                return self.__pipelines(method, kind[:5], segments[1:], params, body)
+            if kind == "solr" and len(segments) == 3:
+                return self.__solr(method, self.collection(segments[1]), segments[2], params, body)
+            raise FakeError(404, "No such path %s" % path)
+
+    def __api(self, method, body):
+        if method == "POST":
+            if self.initialized:
+                raise FakeError(409, "The admin password is already set")
+            password = json.loads(body).get("password", "")
+            if len(password) < 8:
+                return 400, {"code": "invalid-password"}
+            self.password = password
+            self.initialized = True
+            return 201, None
+        init_meta = {"version": "fake", "initializedAt": "2016-02-25T03:31:45Z"} if self.initialized else None
+        return 200, {"version": "fake", "enabledRealms": ["native"], "initMeta": init_meta,
+                     "startTime": "2016-02-25T03:29:55Z",
+                     "status": {"knownServiceNodes": ["127.0.0.1:8764"], "connectors": {"ping": True},
+                                "apollo": {"ping": True}, "apolloZk": {"ping": True}, "db": {"ping": True}}}
+
+    def __collections(self, method, segments, params, body, content_type):
+        if not segments:
+            return 200, [c.config for _, c in sorted(self.collections.items())]
+        name = segments[0]
+        if len(segments) == 1:
+            if method == "PUT":
+                if name in self.collections:
+                    raise FakeError(409, "Collection %s already exists" % name)
+                self.collections[name] = FakeCollection(name, json.loads(body) if body else None)
+                return 200, self.collections[name].config
+            c = self.collection(name)
+            if method == "DELETE":
+                del self.collections[name]
+                return 204, None
+            return 200, c.config
+        c = self.collection(name)
+        what = segments[1]
+        if what == "stats":
+            return 200, {"collectionId": name, "documentCount": len(c.docs), "qps": 0.0, "sizeInBytes": 0}
+        if what == "features":
+            if len(segments) == 3 and method == "PUT":
+                c.features[segments[2]] = json.loads(body)["enabled"]
+                return 204, None
+            return 200, [{"name": f, "collectionId": name, "enabled": e} for f, e in sorted(c.features.items())]
+        if what == "solr-config":
+            return self.__solr_config(method, c, segments[2:], body, content_type)
+        raise FakeError(404, "No such collection resource %s" % what)
+
+    def __solr_config(self, method, c, segments, body, content_type):
+        if not segments:
+            return 200, [{"name": f, "isDir": False, "version": v} for f, (_, _, v) in sorted(c.files.items())]
+        name = segments[0]
+        if method == "GET":
+            if name not in c.files:
+                raise FakeError(404, "No file %s" % name)
+            content_type, content, _ = c.files[name]
+            return 200, content_type, content
+        if method == "POST" and name in c.files:
+            raise FakeError(409, "File %s already exists" % name)
+        if method == "PUT" and name not in c.files:
+            raise FakeError(404, "No file %s" % name)
+        version = c.files[name][2] + 1 if name in c.files else 0
+        c.files[name] = (content_type or "application/xml", body, version)
+        return 204, None
+
+    def __pipelines(self, method, ptype, segments, params, body):
+        pipelines = self.pipelines[ptype]
+        if not segments:
+            if method == "POST":
+                pipeline = json.loads(body)
+                if pipeline["id"] in pipelines:
+                    raise FakeError(409, "Pipeline %s already exists" % pipeline["id"])
+                pipelines[pipeline["id"]] = pipeline
+                return 200, pipeline
+            return 200, pipelines.values()
+        pid = segments[0]
+        if pid not in pipelines:
+            raise FakeError(404, "No %s pipeline %s" % (ptype, pid))
+        if len(segments) == 1:
+            if method == "PUT":
+                pipelines[pid] = json.loads(body)
+                return 204, None
+            if method == "DELETE":
+                del pipelines[pid]
+                return 204, None
+            return 200, pipelines[pid]
+        if segments[1] == "refresh":
+            return 204, None
+        if len(segments) == 4 and segments[1] == "collections":
+            c = self.collection(segments[2])
+            if ptype == "index" and segments[3] == "index" and method == "POST":
+                return self.__index(c, params, json.loads(body))
+            if ptype == "query" and method == "GET":
+                return 200, search(c.docs.values(), params)
+        raise FakeError(404, "No such pipeline resource %s" % "/".join(segments))
+
+    @staticmethod
+    def __index(c, params, docs):
+        if isinstance(docs, dict):
+            if "commit" in docs:
+                c.commit()
+                return 200, [{"commit": {}}]
+            docs = [docs]
+        c.add(docs)
+        if "commitWithin" in params:
+            c.commit()
+        return 200, docs
+
+    def __solr(self, method, c, handler, params, body):
+        if handler == "schema":
+            if method == "GET":
+                return 200, {"responseHeader": {"status": 0, "QTime": 0}, "schema": c.schema}
+            return 200, self.__change_schema(c, json.loads(body))
+        if handler == "update":
+            update = json.loads(body, object_pairs_hook=_json_object) if body else _json_object([])
+            if isinstance(update, list):
+                c.add(update)
+            else:
+                for command, delete in update.pairs:
+                    if command != "delete":
+                        continue
+                    if isinstance(delete, dict) and "query" in delete:
+                        match = matcher(delete["query"])
+                        c.delete([i for i, d in c.docs.items() if match(d)])
+                    else:
+                        c.delete(d["id"] if isinstance(d, dict) else d for d in
+                                 (delete if isinstance(delete, list) else [delete]))
+            # Committing at once is soon enough for commitWithin
+            if params.get("commit", [""])[-1] == "true" or "commit" in update or "commitWithin" in params:
+                c.commit()
+            return 200, {"responseHeader": {"status": 0, "QTime": 0}}
+        if handler == "export" and method == "GET":
+            # Every match, rather than a page of them, and only with the fields and order given, as Solr requires
+            for required in ("fl", "sort"):
+                if not params.get(required, [""])[-1]:
+                    raise FakeError(400, "export requires %s" % required)
+            return 200, search(c.docs.values(), dict(params, start=["0"], rows=[str(len(c.docs))]))
+        if method == "GET":
+            return 200, search(c.docs.values(), params)
+        raise FakeError(404, "No Solr handler %s" % handler)
+
+    @staticmethod
+    def __change_schema(c, commands):
+        errors = []
+        for command, definition in commands.items():
+            action, _, what = command.partition('-')
+            key = "fieldTypes" if what == "field-type" else "fields"
+            existing = [i for i, f in enumerate(c.schema[key]) if f["name"] == definition["name"]]
+            if action == "add" and not existing:
+                c.schema[key].append(definition)
+            elif action == "replace" and existing:
+                c.schema[key][existing[0]] = definition
+            elif action == "delete" and existing:
+                del c.schema[key][existing[0]]
+            else:
+                errors.append({command: definition, "errorMessages": ["Can't %s %s" % (command, definition["name"])]})
+        if errors:
+            return {"responseHeader": {"status": 0, "QTime": 0}, "errors": errors}
+        return {"responseHeader": {"status": 0, "QTime": 0}}
+
+
+class FakeFusionServer(ThreadingMixIn, HTTPServer):
+    """
+    A FakeFusion served over HTTP on a thread per connection, so that it can take concurrent load:
+
+        server = FakeFusionServer(latency=0.005).start()
+        fusion = Fusion(requester=HttpFusionRequester(server.url))
+        ...
+        server.stop()
+
+    Each response may be delayed by latency seconds, and replaced by an error_status response with probability
+    error_rate.  Request bodies may be gzipped or chunked.  Responses are gzipped for clients that accept it.
+    Safe to share among threads; requests are handled one at a time against the state, but latency is spent
+    concurrently.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, host="127.0.0.1", fusion=None, latency=0.0, error_rate=0.0, error_status=503,
+                 seed=None):
+        """
+        :param port: the port to listen on, 0 to choose a free one
+        :param host: the address to listen on
+        :param fusion: the FakeFusion to serve, by default a new one with a collection named phi
+        :param latency: seconds to wait before each response, or a function taking the method and path template
+           and returning the seconds
+        :param error_rate: the fraction of requests to answer with error_status instead
+        :param error_status: the status of injected errors
+        :param seed: for the random choice of requests to fail, for repeatable runs
+        """
+        HTTPServer.__init__(self, (host, port), FakeFusionHandler)
+        self.fusion = fusion if fusion is not None else FakeFusion()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.requests = defaultdict(int)
+        self.errors_injected = 0
+        self._counts_lock = threading.Lock()
+        self._thread = None
+        self._connections = set()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def collection_url(self, collection="phi"):
+        """
+        :return: a URL for HttpFusionRequester, including the admin credentials
+        """
+        return "http://admin:%s@%s:%d/api/apollo/collections/%s" % (self.fusion.password, self.server_address[0],
+                                                                     self.port, collection)
+
+    @property
+    def url(self):
+        return self.collection_url()
+
+    def count(self, method, path):
+        """
+        Count a request, choose whether to fail it, and wait the latency.
+
+        :return: True if the request should fail with error_status
+        """
+        template = path_template(path)
+        with self._counts_lock:
+            self.requests["%s %s" % (method, template)] += 1
+            fail = self.error_rate > 0 and self.random.random() < self.error_rate
+            if fail:
+                self.errors_injected += 1
+        latency = self.latency(method, template) if callable(self.latency) else self.latency
+        if latency > 0:
+            time.sleep(latency)
+        return fail
+
+    def request_count(self):
+        with self._counts_lock:
+            return sum(self.requests.values())
+
+    def reset_counts(self):
+        with self._counts_lock:
+            self.requests.clear()
+            self.errors_injected = 0
+
+    def process_request(self, request, client_address):
+        with self._counts_lock:
+            self._connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self._counts_lock:
+            self._connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    def start(self):
+        """
+        Serve on a daemon thread.
+
+        :return: self
+        """
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,), name="fake-fusion-%d" % self.port)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving, and close the connections kept alive by clients.
+        """
+        self.shutdown()
+        self.server_close()
+        with self._counts_lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        # Give the handlers a moment to notice, so they don't outlive the interpreter
+        deadline = time.time() + 1.0
+        while self._connections and time.time() < deadline:
+            time.sleep(0.01)
+        if self._thread is not None:
+            self._thread.join()
+
+
+class FakeFusionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send each response in one piece, rather than a packet per header, and without waiting on Nagle
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def __read_body(self):
+        if self.headers.getheader("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';', 1)[0].strip(), 16)
+                if size == 0:
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            # Skip any trailers
+            while self.rfile.readline().strip():
+                pass
+            body = ''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        if self.headers.getheader("Content-Encoding", "").lower() == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body
+
+    def __respond(self, status, content_type=None, content=None):
+        if content is None:
+            data = ""
+        elif isinstance(content, basestring):
+            data = content.encode('utf-8') if isinstance(content, unicode) else content
+        else:
+            data = json.dumps(content)
+            content_type = "application/json"
+        self.send_response(status)
+        if data and content_type:
+            self.send_header("Content-Type", content_type)
+        if len(data) >= GZIP_THRESHOLD and "gzip" in self.headers.getheader("Accept-Encoding", ""):
+            out = BytesIO()
+            with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=1) as gz:
+                gz.write(data)
+            data = out.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def __handle(self):
+        url = urlparse(self.path)
+        body = self.__read_body()
+        server = self.server
+        if server.count(self.command, url.path):
+            return self.__respond(server.error_status, content={"code": "injected-error"})
+        fusion = server.fusion
+        if not fusion.authorized(self.headers.getheader("Authorization")):
+            return self.__respond(401, content={"code": "unauthorized"})
+        try:
+            result = fusion.handle(self.command, url.path, parse_qs(url.query, keep_blank_values=True), body,
+                                   self.headers.getheader("Content-Type"))
+        except FakeError as fe:
+            return self.__respond(fe.status, content={"code": "error", "message": str(fe)})
+        except (ValueError, KeyError, TypeError) as e:
+            return self.__respond(400, content={"code": "bad-request", "message": str(e)})
+        if len(result) == 3:
+            return self.__respond(*result)
+        return self.__respond(result[0], content=result[1])
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = __handle
@@ -2,7 +2,8 @@
 import json
 from fusionpy import FusionError
 from fusionpy.fusioncollection import FusionCollection
-from fusionpy.connectors import FusionRequester, HttpFusionRequester
+from fusionpy.connectors import FusionRequester, HttpFusionRequester, down_services
+from fusionpy.jsoncodec import response_json
 import re
 import os
 import errno
@@ -29,18 +30,33 @@ class Fusion(FusionRequester):
         try:
             resp = self.request('GET', '/api')
         except FusionError as fe:
-            if fe.response is not None and fe.response.status > 200:
-                raise FusionError(fe.response, message="Fusion is not responding to status checks.")
-            else:
-                raise
+            raise self.__ping_error(fe)
+
+        return self.__ping_status(resp)
 
-        rd = json.loads(resp.data)
-        for thing, stats in rd["status"].items():
-            not_working = []
-            if "ping" in stats and not stats["ping"]:
-                not_working.append(thing)
-            if len(not_working) > 0:
-                raise FusionError(resp, "Fusion services %s are not working." % str(not_working))
+    def ping_async(self):
+        """
+        :return: a workers.Future for the result of ping()
+        """
+        def fail(fe):
+            if isinstance(fe, FusionError):
+                raise self.__ping_error(fe)
+            raise fe
+
+        return self.request_async('GET', '/api').then(self.__ping_status, on_error=fail)
+
+    @staticmethod
+    def __ping_error(fe):
+        if fe.response is not None and fe.response.status > 200:
+            return FusionError(fe.response, message="Fusion is not responding to status checks.")
+        return fe
+
+    @staticmethod
+    def __ping_status(resp):
+        rd = response_json(resp)
+        not_working = down_services(rd)
+        if len(not_working) > 0:
+            raise FusionError(resp, "Fusion services %s are not working." % str(not_working))
 
         return rd["initMeta"] is not None
 
@@ -123,7 +139,7 @@ class Fusion(FusionRequester):
         """
         system_collections = re.compile('_signals$|_signals_aggr$|^system_|_logs$|^logs$')
         collections = []
-        for c in json.loads(self.request('GET', 'collections/').data):
+        for c in response_json(self.request('GET', 'collections/')):
             if include_system or not system_collections.search(c["id"]):
                 collections.append(c["id"])
         return collections
@@ -171,7 +187,7 @@ class Pipelines(FusionRequester):
         return True
 
     def get_pipelines(self):
-        return json.loads(self.request('GET', self.ptype + '-pipelines').data)
+        return response_json(self.request('GET', self.ptype + '-pipelines'))
 
     def add_pipeline(self, pipeline):
         self.request('POST', self.ptype + '-pipelines/', body=pipeline)
@@ -1,11 +1,18 @@
 #!/usr/bin/python
-import json
 from fusionpy import FusionError
 from urllib import urlencode
 from os import listdir
 from os.path import isfile, join
 from string import Template
-from connectors import FusionRequester
+from connectors import FusionRequester, JsonArrayStream
+from fusionpy.cache import result_key
+from fusionpy.columns import ColumnarResult, field_list
+from fusionpy.jsonstream import iter_docs
+from fusionpy import jsoncodec
+from fusionpy.jsoncodec import response_json
+from fusionpy.workers import WorkerPool, as_completed, completed
+from fusionpy.indexing import batches, send_batch, IndexReport, ParallelIndexer, ParallelDeleter, \
+    AdaptiveIndexer, AdaptiveBatchController, DEFAULT_BATCH_SIZE, DEFAULT_BATCH_BYTES
 
 __author__ = 'jscarbor'
 
@@ -22,12 +29,25 @@ class FusionCollection(FusionRequester):
         self.config_files = ConfigFiles(self)
         self.field_types = FieldTypes(self)
         self.fields = Fields(self)
+        self.batch_controllers = {}
+        self.commit_policy = None
+        self.result_cache = None
 
     def request(self, method, path, headers=None, fields=None, body=None, validate=None):
         if path.find("$") >= 0:
             path = Template(path).safe_substitute(collection=self.collection_name)
         return super(FusionCollection, self).request(method, path, headers, fields, body, validate)
 
+    def request_stream(self, method, path, headers=None, fields=None):
+        if path.find("$") >= 0:
+            path = Template(path).safe_substitute(collection=self.collection_name)
+        return super(FusionCollection, self).request_stream(method, path, headers, fields)
+
+    def request_async(self, method, path, headers=None, fields=None, body=None, validate=None):
+        if path.find("$") >= 0:
+            path = Template(path).safe_substitute(collection=self.collection_name)
+        return super(FusionCollection, self).request_async(method, path, headers, fields, body, validate)
+
     def exists(self):
         """
         :return: True if the collection exists, False otherwise
@@ -45,7 +65,7 @@ class FusionCollection(FusionRequester):
         :return: The json config for the collection (which evaluates True) if the collection exists, False otherwise.
         """
         resp = self.request('GET', "collections/$collection")
-        return json.loads(resp.data)
+        return response_json(resp)
 
     def delete_collection(self, purge=False, solr=False):
         self.request('DELETE',
@@ -127,60 +147,514 @@ class FusionCollection(FusionRequester):
     def get_features(self):
         resp = self.request('GET', 'collections/$collection/features')
         features = {}
-        for feature in json.loads(resp.data):
+        for feature in response_json(resp):
             features[feature['name']] = feature['enabled']
         return features
 
     def stats(self):
         resp = self.request('GET',
                             'collections/$collection/stats')
-        return json.loads(resp.data)
+        return response_json(resp)
+
+    def stats_async(self):
+        """
+        :return: a workers.Future for the result of stats()
+        """
+        return self.request_async('GET', 'collections/$collection/stats').then(response_json)
 
     def clear_collection(self):
         if self.stats()["documentCount"] > 0:
             resp = self.request('POST',
                                 'solr/$collection/update?commit=true',
                                 body={"delete": {"query": "*:*"}})
+            self.__invalidate()
+
+    def __invalidate(self):
+        if self.result_cache is not None:
+            self.result_cache.invalidate(self.collection_name)
 
-    def __query(self, qurl, handler="select", qparams=None):
+    @staticmethod
+    def __query_path(qurl, handler="select", qparams=None):
         qp = {}
         if qparams is not None:
             qp.update(qparams)
         if "wt" not in qp:
             qp["wt"] = "json"
-        resp = self.request('GET', qurl + "/" + handler + '?' + urlencode(qp))
+        return qurl + "/" + handler + '?' + urlencode(qp)
+
+    def __cache_key(self, qurl, handler, qparams, use_cache):
+        if not use_cache or self.result_cache is None:
+            return None
+        return result_key(self.collection_name, qurl, handler, qparams or {})
+
+    def __cached(self, key, resp):
+        if key is not None:
+            self.result_cache.put(key, resp.data)
+        # Memoized on the response, so that callers sharing it through a SingleFlightRequester decode it once
+        return response_json(resp)
+
+    def __query(self, qurl, handler="select", qparams=None, use_cache=True):
+        key = self.__cache_key(qurl, handler, qparams, use_cache)
+        if key is not None:
+            data = self.result_cache.get(key)
+            if data is not None:
+                return jsoncodec.loads(data)
+
+        resp = self.request('GET', self.__query_path(qurl, handler, qparams))
+
+        return self.__cached(key, resp)
+
+    def __query_async(self, qurl, handler="select", qparams=None, use_cache=True):
+        key = self.__cache_key(qurl, handler, qparams, use_cache)
+        if key is not None:
+            data = self.result_cache.get(key)
+            if data is not None:
+                return completed(jsoncodec.loads, data)
 
-        return json.loads(resp.data)
+        return self.request_async('GET', self.__query_path(qurl, handler, qparams)).then(
+            lambda resp: self.__cached(key, resp))
 
-    def query(self, handler="select", pipeline="default", qparams=None, **__qp1):
+    def query(self, handler="select", pipeline="default", qparams=None, use_cache=True, **__qp1):
+        """
+        :param use_cache: False to bypass the result_cache, if there is one
+        :return: the decoded response.  Callers coalesced by a SingleFlightRequester share one, so don't modify it.
+        """
         if qparams is None:
             qparams = {}
         qparams.update(__qp1)
         return self.__query(qurl='query-pipelines/%s/collections/$collection' % pipeline,
-                            handler=handler, qparams=qparams)
+                            handler=handler, qparams=qparams, use_cache=use_cache)
 
-    def solrquery(self, handler="select", qparams=None, **__qp1):
+    def query_async(self, handler="select", pipeline="default", qparams=None, use_cache=True, **__qp1):
+        """
+        :return: a workers.Future for the result of query() with the same parameters
+        """
         if qparams is None:
             qparams = {}
         qparams.update(__qp1)
-        return self.__query(qurl='solr/$collection', handler=handler, qparams=qparams)
+        return self.__query_async(qurl='query-pipelines/%s/collections/$collection' % pipeline,
+                                  handler=handler, qparams=qparams, use_cache=use_cache)
+
+    def solrquery(self, handler="select", qparams=None, use_cache=True, **__qp1):
+        """
+        :param use_cache: False to bypass the result_cache, if there is one
+        """
+        if qparams is None:
+            qparams = {}
+        qparams.update(__qp1)
+        return self.__query(qurl='solr/$collection', handler=handler, qparams=qparams, use_cache=use_cache)
+
+    def solrquery_async(self, handler="select", qparams=None, use_cache=True, **__qp1):
+        """
+        :return: a workers.Future for the result of solrquery() with the same parameters
+        """
+        if qparams is None:
+            qparams = {}
+        qparams.update(__qp1)
+        return self.__query_async(qurl='solr/$collection', handler=handler, qparams=qparams, use_cache=use_cache)
+
+    def __cursor(self, qurl, handler, qparams, rows, prefetch):
+        qp = {"sort": "id asc", "rows": rows}
+        qp.update(qparams)
+        if "start" in qp:
+            raise ValueError("Paging by cursorMark can't be combined with start")
+
+        def fetch(mark):
+            page = dict(qp)
+            page["cursorMark"] = mark
+            return self.__query(qurl, handler=handler, qparams=page, use_cache=False)
+
+        pool = WorkerPool(1) if prefetch else None
+        try:
+            mark = "*"
+            resp = fetch(mark)
+            while True:
+                next_mark = resp.get("nextCursorMark", mark)
+                upcoming = None
+                if pool is not None and next_mark != mark:
+                    upcoming = pool.submit(fetch, next_mark)
+                for doc in resp["response"]["docs"]:
+                    yield doc
+                if next_mark == mark:
+                    return
+                mark = next_mark
+                resp = upcoming.result() if upcoming is not None else fetch(mark)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False)
+
+    def query_cursor(self, handler="select", pipeline="default", qparams=None, rows=1000, prefetch=False, **__qp1):
+        """
+        Walk all the results of a query, a page at a time, with cursorMark, so that each page costs the same however
+        deep it is.
+
+        :param qparams: as for query().  The sort must end with the uniqueKey field; it defaults to "id asc".
+        :param rows: the number of documents to request per page
+        :param prefetch: True to request the next page while the documents of the current one are consumed
+        :return: a generator of the documents
+        """
+        if qparams is None:
+            qparams = {}
+        qparams.update(__qp1)
+        return self.__cursor('query-pipelines/%s/collections/$collection' % pipeline, handler, qparams, rows,
+                             prefetch)
+
+    def solrquery_cursor(self, handler="select", qparams=None, rows=1000, prefetch=False, **__qp1):
+        """
+        Walk all the results of a Solr query with cursorMark.  Parameters are as for query_cursor().
+
+        :return: a generator of the documents
+        """
+        if qparams is None:
+            qparams = {}
+        qparams.update(__qp1)
+        return self.__cursor('solr/$collection', handler, qparams, rows, prefetch)
+
+    def query_many(self, qparam_sets, handler="select", pipeline="default", workers=8, ordered=True, solr=False,
+                   use_cache=True):
+        """
+        Run many queries concurrently over the shared connection pool.  A query that fails doesn't stop the others;
+        its error is returned in its place.
+
+        :param qparam_sets: a sequence of qparams dicts, as for query()
+        :param handler: the request handler for every query
+        :param pipeline: the query pipeline for every query
+        :param workers: the most queries to have in flight at once
+        :param ordered: True to return a list in the order of qparam_sets, False for a generator in the order the
+           queries finish
+        :param solr: True to query Solr directly, as solrquery() does, rather than through the pipeline
+        :param use_cache: False to bypass the result_cache, if there is one
+        :return: QueryOutcome for each query
+        """
+        if solr:
+            qurl = 'solr/$collection'
+        else:
+            qurl = 'query-pipelines/%s/collections/$collection' % pipeline
+        qparam_sets = list(qparam_sets)
+        pool = WorkerPool(max(1, min(workers, len(qparam_sets))))
+        futures = [pool.submit(self.__query, qurl, handler, qp, use_cache) for qp in qparam_sets]
+        positions = dict((id(f), i) for i, f in enumerate(futures))
+
+        def outcome(i, future):
+            error = future.exception()
+            return QueryOutcome(i, qparam_sets[i], None if error is not None else future.result(), error)
+
+        def finished():
+            try:
+                for f in as_completed(futures):
+                    yield outcome(positions[id(f)], f)
+            finally:
+                pool.shutdown(wait=False)
+
+        if not ordered:
+            return finished()
+        try:
+            return [outcome(i, f) for i, f in enumerate(futures)]
+        finally:
+            pool.shutdown(wait=False)
+
+    def query_columns(self, fl, handler="select", pipeline="default", qparams=None, types=None, solr=False,
+                      use_cache=True, **__qp1):
+        """
+        Run a query and return its documents as columns rather than as a dict apiece: NumPy arrays for numbers and
+        dates (array.array without NumPy), columns.StringColumn for strings, and lists for multivalued fields.
+        Facet counts come back as columns of values and counts.  The response is decoded one document at a time
+        straight into the columns, so only the body and the columns are held, not a dict for every document.
+
+        :param fl: the fields to return, as a list or a comma separated string
+        :param qparams: as for query(); fl is set from the fl parameter
+        :param types: if specified, a dict of field name to one of columns.TYPES, for fields whose type shouldn't
+           be inferred from the values
+        :param solr: True to query Solr directly, as solrquery() does, rather than through the pipeline
+        :return: a columns.ColumnarResult
+        """
+        fl = field_list(fl)
+        if qparams is None:
+            qparams = {}
+        qparams.update(__qp1)
+        qparams["fl"] = ",".join(fl)
+        if solr:
+            qurl = 'solr/$collection'
+        else:
+            qurl = 'query-pipelines/%s/collections/$collection' % pipeline
+        key = self.__cache_key(qurl, handler, qparams, use_cache)
+        data = self.result_cache.get(key) if key is not None else None
+        if data is None:
+            data = self.request('GET', self.__query_path(qurl, handler, qparams)).data
+            if key is not None:
+                self.result_cache.put(key, data)
+        return ColumnarResult.parse(data, fl, types)
+
+    def __stream(self, qurl, handler, qparams, batch_size, chunk_size):
+        resp = self.request_stream('GET', self.__query_path(qurl, handler, qparams))
+        try:
+            for docs in iter_docs(resp.stream(chunk_size), batch_size=batch_size):
+                yield docs
+        finally:
+            resp.release_conn()
+
+    def query_stream(self, handler="select", pipeline="default", qparams=None, batch_size=None, chunk_size=65536,
+                     **__qp1):
+        """
+        Run a query, parsing the documents out of the response as it arrives, so memory doesn't depend on the
+        number of results.
+
+        :param qparams: as for query()
+        :param batch_size: None to yield documents one at a time, or the number of documents to yield in each list
+        :param chunk_size: the most bytes to read from the connection at once
+        :return: a generator of documents, or of lists of documents
+        """
+        if qparams is None:
+            qparams = {}
+        qparams.update(__qp1)
+        return self.__stream('query-pipelines/%s/collections/$collection' % pipeline, handler, qparams, batch_size,
+                             chunk_size)
+
+    def export(self, qparams=None, handler="export", batch_size=None, chunk_size=65536, **__qp1):
+        """
+        Dump documents with Solr's /export handler (which needs fl and sort on docValues fields), parsing them out
+        of the response as it arrives.
+
+        :param qparams: as for solrquery()
+        :param batch_size: None to yield documents one at a time, or the number of documents to yield in each list
+        :param chunk_size: the most bytes to read from the connection at once
+        :return: a generator of documents, or of lists of documents
+        """
+        if qparams is None:
+            qparams = {}
+        qparams.update(__qp1)
+        return self.__stream('solr/$collection', handler, qparams, batch_size, chunk_size)
 
     def commit(self):
-        self.index({'commit': {}})
+        """
+        Commit indexed documents.  While a commit_policy is set, this only commits if the policy says a commit is
+        due; otherwise the request is coalesced with the next commit the policy makes, or with flush().
+        """
+        if self.commit_policy is None or self.commit_policy.request_commit():
+            self.__send_commit()
+
+    def flush(self):
+        """
+        Commit now if anything indexed or requested under the commit_policy has not been committed.
+        :return: True if a commit was sent
+        """
+        if self.commit_policy is None or self.commit_policy.flush():
+            self.__send_commit()
+            return True
+        return False
+
+    def __send_commit(self):
+        resp = self.request('POST', 'index-pipelines/default/collections/$collection/index',
+                            body={'commit': {}})
+        self.__check_written(resp, 1)
+        self.__invalidate()
+
+    def __index_path(self, pipeline):
+        return self.__commit_within('index-pipelines/%s/collections/$collection/index' % pipeline)
+
+    def __commit_within(self, path):
+        if self.commit_policy is not None and self.commit_policy.commit_within is not None:
+            path += '?' + urlencode({"commitWithin": int(self.commit_policy.commit_within * 1000)})
+        return path
+
+    def __written(self, resp, submitted):
+        wrote = self.__check_written(resp, submitted)
+        self.__record(wrote)
+        return wrote
+
+    def __record(self, count):
+        self.__invalidate()
+        if self.commit_policy is not None and self.commit_policy.record(count):
+            self.__send_commit()
 
     def index(self, docs, pipeline="default"):
-        resp = self.request('POST', 'index-pipelines/%s/collections/$collection/index' %
-                            pipeline,
-                            body=docs
+        """
+        Send documents to the index pipeline in one request.
+
+        :param docs: a dict (such as a commit), or a list or any other iterable of documents, which is encoded as
+           it is sent with chunked transfer encoding, so only about one encoded document is in memory at once
+        :param pipeline: the index pipeline to use
+        :return: the number of documents written, FusionError if that differs from the number submitted
+        """
+        if isinstance(docs, dict):
+            submitted = len(docs)
+        else:
+            docs = JsonArrayStream(docs)
+        resp = self.request('POST', self.__index_path(pipeline), body=docs)
+        if isinstance(docs, JsonArrayStream):
+            submitted = docs.count
+        return self.__written(resp, submitted)
+
+    def index_async(self, docs, pipeline="default"):
+        """
+        :param docs: as for index(); documents are encoded as they are sent, on the worker
+        :return: a workers.Future for the number of documents written, which raises FusionError as index() would
+        """
+        if isinstance(docs, dict):
+            submitted = len(docs)
+        else:
+            docs = JsonArrayStream(docs)
+            submitted = None
+        # A stream has only been counted once it is sent
+        return self.request_async('POST', self.__index_path(pipeline), body=docs).then(
+            lambda resp: self.__written(resp, docs.count if submitted is None else submitted))
+
+    def index_batch(self, batch, pipeline="default"):
+        """
+        Send one pre-serialized batch to the index pipeline.
+
+        :param batch: an indexing.Batch
+        :param pipeline: the index pipeline to use
+        :return: the number of documents written, FusionError if that differs from the size of the batch
+        """
+        resp = self.request('POST', self.__index_path(pipeline),
+                            headers={"Content-Type": "application/json"},
+                            body=batch.request_body()
                             )
-        wrote = len(json.loads(resp.data))
-        if wrote != len(docs):
+        return self.__written(resp, len(batch))
+
+    def index_stream(self, docs, pipeline="default", batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES,
+                     progress=None, retry_policy=None):
+        """
+        Index any iterable of documents, sending it in batches bounded by count and by serialized size so that
+        memory stays flat however long the input is.
+
+        :param docs: an iterable or generator of dicts
+        :param pipeline: the index pipeline to use
+        :param batch_size: the most documents to send in one request
+        :param batch_bytes: the most serialized bytes to send in one request
+        :param progress: if specified, a function taking one parameter, the indexing.BatchResult of each batch
+        :param retry_policy: a connectors.RetryPolicy to retry failed batches and split them to isolate the
+           documents that can't be written, or None to stop at the first failure
+        :return: an indexing.IndexReport, or FusionError for the first batch that was not completely written
+           (without a retry_policy)
+        """
+        report = IndexReport()
+        for batch in batches(docs, max_docs=batch_size, max_bytes=batch_bytes):
+            result = send_batch(self, batch, pipeline=pipeline, retry_policy=retry_policy)
+            if result.error is not None and retry_policy is None:
+                raise result.error
+            report.add(result)
+            if progress is not None:
+                progress(result)
+        return report.finish()
+
+    def index_parallel(self, docs, pipeline="default", workers=4, progress=None, **kwargs):
+        """
+        Index any iterable of documents with several batches in flight at once.
+
+        :param docs: an iterable or generator of dicts
+        :param pipeline: the index pipeline to use
+        :param workers: the most batches to have in flight at once
+        :param progress: if specified, a function taking one parameter, the indexing.BatchResult of each batch
+        :param kwargs: further parameters for indexing.ParallelIndexer, such as batch_size or max_outstanding_bytes
+        :return: an indexing.IndexReport, whose errors identify the batches that failed
+        """
+        return ParallelIndexer(self, pipeline=pipeline, workers=workers, **kwargs).run(docs, progress=progress)
+
+    def index_adaptive(self, docs, pipeline="default", progress=None, retry_policy=None, **kwargs):
+        """
+        Index any iterable of documents, letting observed round trip times and errors choose the batch size and
+        the number of batches in flight.  What was learned is kept per pipeline in batch_controllers, so later
+        runs start from where earlier ones settled.
+
+        :param docs: an iterable or generator of dicts
+        :param pipeline: the index pipeline to use
+        :param progress: if specified, a function taking one parameter, the indexing.BatchResult of each batch
+        :param retry_policy: a connectors.RetryPolicy for retrying and splitting failed batches, or None
+        :param kwargs: parameters for a new indexing.AdaptiveBatchController, if there is none yet for the pipeline
+        :return: an indexing.IndexReport, whose errors identify the batches that failed
+        """
+        if pipeline not in self.batch_controllers:
+            self.batch_controllers[pipeline] = AdaptiveBatchController(**kwargs)
+        return AdaptiveIndexer(self, pipeline=pipeline, controller=self.batch_controllers[pipeline],
+                               retry_policy=retry_policy).run(docs, progress=progress)
+
+    def delete_batch(self, batch, by="id"):
+        """
+        Delete the documents named in one batch, committed within the commit_policy's commit_within, if it has one.
+
+        :param batch: an indexing.Batch of json encoded ids, or of json encoded queries
+        :param by: "id" or "query"
+        :return: the number of ids or queries in the batch
+        """
+        if by == "id":
+            body = '{"delete":[' + ','.join(batch.encoded_docs) + ']}'
+        else:
+            # A delete command for each query, as Solr allows the key to repeat, so that each is parsed on its own
+            body = '{' + ','.join('"delete":{"query":%s}' % q for q in batch.encoded_docs) + '}'
+        self.request('POST', self.__commit_within('solr/$collection/update'),
+                     headers={"Content-Type": "application/json"},
+                     body=body)
+        self.__record(len(batch))
+        return len(batch)
+
+    def delete_by_id(self, ids, batch_size=1000, workers=4, progress=None, **kwargs):
+        """
+        Delete documents by id, in concurrent batches.  Deletions count toward the commit_policy as indexed
+        documents do.
+
+        :param ids: an iterable or generator of document ids
+        :param batch_size: the most ids to send in one request
+        :param workers: the most batches to have in flight at once
+        :param progress: if specified, a function taking one parameter, the indexing.BatchResult of each batch
+        :param kwargs: further parameters for indexing.ParallelDeleter, such as retry_policy
+        :return: an indexing.IndexReport, whose errors identify the batches that failed
+        """
+        return ParallelDeleter(self, by="id", batch_size=batch_size, workers=workers, **kwargs).run(
+            ids, progress=progress)
+
+    def delete_by_query(self, queries, batch_size=64, workers=4, progress=None, **kwargs):
+        """
+        Delete the documents matching any of the queries.  Queries are combined with OR, batch_size at a time,
+        so keep batch_size within Solr's maxBooleanClauses.
+
+        :param queries: an iterable of Solr queries
+        :param batch_size: the most queries to combine into one request
+        :param workers: the most batches to have in flight at once
+        :param progress: if specified, a function taking one parameter, the indexing.BatchResult of each batch
+        :param kwargs: further parameters for indexing.ParallelDeleter, such as retry_policy
+        :return: an indexing.IndexReport, whose errors identify the batches that failed
+        """
+        return ParallelDeleter(self, by="query", batch_size=batch_size, workers=workers, **kwargs).run(
+            queries, progress=progress)
+
+    @staticmethod
+    def __check_written(resp, submitted):
+        wrote = len(response_json(resp))
+        if wrote != submitted:
             raise FusionError(resp,
-                              message="Submitted %d documents to index, but wrote %d" % (len(docs), wrote))
+                              message="Submitted %d documents to index, but wrote %d" % (submitted, wrote))
+        return wrote
 
     def schema(self):
         resp = self.request('GET', "solr/$collection/schema")
-        return json.loads(resp.data)["schema"]
+        return response_json(resp)["schema"]
+
+
+class QueryOutcome(object):
+    """
+    The result of one query run by FusionCollection.query_many.
+    """
+
+    def __init__(self, index, qparams, result=None, error=None):
+        """
+        :param index: the position of the query in the sequence given to query_many
+        :param qparams: the query parameters
+        :param result: the decoded response, if the query succeeded
+        :param error: the exception raised, if it failed
+        """
+        self.index = index
+        self.qparams = qparams
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "QueryOutcome(index=%d, ok=%r)" % (self.index, self.ok)
 
 
 class AbstractFieldsConfig(FusionRequester):
@@ -243,7 +717,7 @@ class AbstractFieldsConfig(FusionRequester):
         self.request('POST',
                      "solr/$collection/schema",
                      body={action: field_descriptor},
-                     validate=lambda resp: "errors" not in json.loads(resp.data))
+                     validate=lambda resp: "errors" not in response_json(resp))
 
         return self
 
@@ -284,7 +758,7 @@ class ConfigFiles(FusionRequester):
         resp = self.request(
             'GET',
             "collections/$collection/solr-config")
-        rd = json.loads(resp.data)
+        rd = response_json(resp)
         if "errors" in rd:
             raise FusionError(resp)
         return rd
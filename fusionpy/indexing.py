@@ -0,0 +1,705 @@
+import gzip
+import mmap
+import os
+import threading
+import time
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from fusionpy import FusionError, jsoncodec
+from fusionpy.connectors import JsonArrayStream
+from fusionpy.workers import WorkerPool
+
+"""
+Contains helpers for pushing large numbers of documents into Fusion index pipelines
+"""
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_BATCH_BYTES = 5 * 1024 * 1024
+
+
+class Batch(object):
+    """
+    A run of documents, already serialized, ready to be posted to an index pipeline.
+    """
+
+    def __init__(self, number, encoded_docs, nbytes=None, offset=0):
+        """
+        :param number: the ordinal of this batch within the run, starting at 0
+        :param encoded_docs: a list of documents, each already encoded as a json string
+        :param nbytes: the total size of the encoded documents, computed if not supplied
+        :param offset: for part of a split batch, the position of its first document within the original batch
+        """
+        self.number = number
+        self.encoded_docs = encoded_docs
+        if nbytes is None:
+            nbytes = sum(len(d) for d in encoded_docs)
+        self.nbytes = nbytes
+        self.offset = offset
+
+    def split(self):
+        """
+        :return: two batches with the same number, each with half of the documents
+        """
+        half = len(self.encoded_docs) // 2
+        return [Batch(self.number, self.encoded_docs[0:half], offset=self.offset),
+                Batch(self.number, self.encoded_docs[half:], offset=self.offset + half)]
+
+    def __len__(self):
+        return len(self.encoded_docs)
+
+    def body(self):
+        """
+        :return: the json array of the documents in this batch
+        """
+        return '[' + ','.join(self.encoded_docs) + ']'
+
+    def request_body(self):
+        """
+        :return: the body to post: a JsonArrayStream of the documents, so that they aren't joined into one more
+           string as large as the batch
+        """
+        return JsonArrayStream(self.encoded_docs, encoded=True)
+
+
+class BatchResult(object):
+    """
+    The outcome of sending one batch.
+    """
+
+    def __init__(self, batch, written=0, seconds=0.0, error=None, failed=None, retries=0, rejected=False):
+        """
+        :param batch: the Batch sent
+        :param written: the number of documents Fusion reported writing
+        :param seconds: the time taken to send the batch, including any retries
+        :param error: the FusionError that stopped some or all of the batch from being written, or None
+        :param failed: the parts of the batch that could not be written, if it was split to isolate them
+        :param retries: the number of requests repeated after retryable errors
+        :param rejected: True if the failed parts are only documents that Fusion refused, isolated by splitting the
+           batch, so that sending them again would fail the same way
+        """
+        self.batch = batch
+        self.written = written
+        self.seconds = seconds
+        self.error = error
+        self.failed = failed or []
+        self.retries = retries
+        self.rejected = rejected
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "BatchResult(batch=%d, docs=%d, bytes=%d, written=%d, seconds=%.3f, error=%r)" % (
+            self.batch.number, len(self.batch), self.batch.nbytes, self.written, self.seconds, self.error)
+
+
+class IndexReport(object):
+    """
+    The per-batch results of an indexing run, with totals.
+    """
+
+    def __init__(self):
+        self.results = []
+        self.started = time.time()
+        self.finished = None
+
+    def add(self, result):
+        self.results.append(result)
+
+    def finish(self):
+        self.finished = time.time()
+        self.results.sort(key=lambda r: r.batch.number)
+        return self
+
+    @property
+    def docs(self):
+        return sum(len(r.batch) for r in self.results)
+
+    @property
+    def written(self):
+        return sum(r.written for r in self.results)
+
+    @property
+    def bytes(self):
+        return sum(r.batch.nbytes for r in self.results)
+
+    @property
+    def errors(self):
+        return [r for r in self.results if not r.ok]
+
+    @property
+    def seconds(self):
+        return (self.finished or time.time()) - self.started
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+
+def send_batch(collection, batch, pipeline="default", retry_policy=None, send=None):
+    """
+    Send one batch, capturing any failure in the result rather than raising it.
+
+    With a retry_policy, retryable errors (such as a 503 while Fusion restarts) are retried with backoff.  Errors
+    the documents may cause, a 4xx such as 400 or 413 or a short write, split the batch in half and each half is
+    sent on its own, down to single documents, so that only the documents that can't be indexed are left out.  Any
+    other error, once retries are exhausted, fails the batch whole.  Documents are indexed by id, so sending one
+    again is harmless.
+
+    :param collection: the FusionCollection to index into
+    :param batch: the Batch to send
+    :param pipeline: the index pipeline to use
+    :param retry_policy: a connectors.RetryPolicy, or None to give up on the first error
+    :param send: the function taking a batch, sending it, and returning the number of documents written, or None
+       to index it with collection.index_batch
+    :return: BatchResult, listing in failed the parts of the batch that were not written
+    """
+    if send is None:
+        send = lambda b: collection.index_batch(b, pipeline=pipeline)
+    start = time.time()
+    if retry_policy is None:
+        try:
+            written = send(batch)
+            return BatchResult(batch, written=written, seconds=time.time() - start)
+        except FusionError as fe:
+            return BatchResult(batch, seconds=time.time() - start, error=fe, failed=[batch])
+
+    written = 0
+    retries = 0
+    error = None
+    failed = []
+    pending = [batch]
+    while pending:
+        part = pending.pop(0)
+        attempt = 0
+        while True:
+            try:
+                written += send(part)
+                break
+            except FusionError as fe:
+                if retry_policy.should_retry(fe, attempt):
+                    retry_policy.wait(attempt)
+                    attempt += 1
+                    retries += 1
+                    continue
+                error = fe
+                if not _rejected(fe, retry_policy):
+                    # The documents aren't at fault, so leave this part and the rest whole rather than send each
+                    # half to the same failure
+                    failed.append(part)
+                    failed.extend(pending)
+                    pending = []
+                elif len(part) > 1:
+                    pending[0:0] = part.split()
+                else:
+                    failed.append(part)
+                break
+    if not failed:
+        error = None
+    return BatchResult(batch, written=written, seconds=time.time() - start, error=error, failed=failed,
+                       retries=retries, rejected=error is not None and _rejected(error, retry_policy))
+
+
+def _rejected(error, retry_policy):
+    """
+    :return: True if Fusion answered error with a status that the documents sent may be to blame for: a short write,
+       or a 4xx that retry_policy wouldn't retry
+    """
+    status = getattr(error.response, 'status', None)
+    return status is not None and status < 500 and status not in retry_policy.statuses
+
+
+def batches(docs, max_docs=DEFAULT_BATCH_SIZE, max_bytes=DEFAULT_BATCH_BYTES, encode=None):
+    """
+    Cut an iterable of documents into batches, each limited by document count and by serialized size.  Documents are
+    pulled from the iterable only as needed, so at most one batch is held in memory at a time.  A single document
+    larger than max_bytes is sent in a batch by itself.
+
+    :param docs: any iterable (a list, a generator, a file reader...) of dicts
+    :param max_docs: the most documents to put in one batch, or a function returning that number, which is consulted
+       as each batch is started
+    :param max_bytes: the most serialized bytes to put in one batch
+    :param encode: the function to serialize one document, or None for jsoncodec.dumps
+    :return: a generator of Batch
+    """
+    if encode is None:
+        encode = jsoncodec.dumps
+    if callable(max_docs):
+        batch_limit = max_docs
+    else:
+        if max_docs < 1:
+            raise ValueError("max_docs must be at least 1")
+        batch_limit = lambda: max_docs
+    number = 0
+    pending = []
+    pending_bytes = 0
+    limit = None
+    for doc in docs:
+        encoded = encode(doc)
+        if pending and (len(pending) >= limit or pending_bytes + len(encoded) + 1 > max_bytes):
+            yield Batch(number, pending, pending_bytes)
+            number += 1
+            pending = []
+            pending_bytes = 0
+        if not pending:
+            limit = max(1, batch_limit())
+        pending.append(encoded)
+        pending_bytes += len(encoded)
+    if pending:
+        yield Batch(number, pending, pending_bytes)
+
+
+class ParallelIndexer(object):
+    """
+    Keeps several batches in flight at once against one index pipeline.  Every batch goes through the collection's
+    requester, so all workers share its connection pool; give the pool at least as many connections as there are
+    workers so they are reused rather than discarded.
+    """
+
+    def __init__(self, collection, pipeline="default", workers=4, max_outstanding_bytes=8 * DEFAULT_BATCH_BYTES,
+                 batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES, pool=None, retry_policy=None,
+                 encode=None):
+        """
+        :param collection: the FusionCollection to index into
+        :param pipeline: the index pipeline to use
+        :param workers: the most batches to have in flight at once
+        :param max_outstanding_bytes: the most serialized bytes to have in flight at once.  A batch larger than this
+           is still sent, but only when nothing else is outstanding.
+        :param batch_size: the most documents to send in one request
+        :param batch_bytes: the most serialized bytes to send in one request
+        :param pool: a workers.WorkerPool to run on, or None to start (and stop) one per run
+        :param retry_policy: a connectors.RetryPolicy for retrying and splitting failed batches, or None
+        :param encode: the function to serialize one document, or an identity function if they are already json,
+           or None for jsoncodec.dumps
+        """
+        self.collection = collection
+        self.pipeline = pipeline
+        self.workers = workers
+        self.max_outstanding_bytes = max_outstanding_bytes
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.pool = pool
+        self.retry_policy = retry_policy
+        self.encode = encode
+        self._condition = threading.Condition()
+        self._outstanding_batches = 0
+        self._outstanding_bytes = 0
+
+    def send(self, batch):
+        """
+        Send one batch, capturing any failure in the result rather than raising it.
+
+        :return: BatchResult
+        """
+        return send_batch(self.collection, batch, pipeline=self.pipeline, retry_policy=self.retry_policy)
+
+    def batches(self, docs):
+        return batches(docs, max_docs=self.batch_size, max_bytes=self.batch_bytes, encode=self.encode)
+
+    def concurrency(self):
+        """
+        :return: the most batches to have in flight right now
+        """
+        return self.workers
+
+    def __await_slot(self):
+        with self._condition:
+            while self._outstanding_batches >= self.concurrency():
+                self._condition.wait()
+
+    def __acquire(self, batch):
+        with self._condition:
+            while self._outstanding_batches >= self.concurrency() or (
+                            self._outstanding_batches > 0 and
+                            self._outstanding_bytes + batch.nbytes > self.max_outstanding_bytes):
+                self._condition.wait()
+            self._outstanding_batches += 1
+            self._outstanding_bytes += batch.nbytes
+
+    def __release(self, batch):
+        with self._condition:
+            self._outstanding_batches -= 1
+            self._outstanding_bytes -= batch.nbytes
+            self._condition.notify_all()
+
+    def run(self, docs, progress=None, raise_on_error=False):
+        """
+        Index all the documents.
+
+        :param docs: an iterable or generator of dicts
+        :param progress: if specified, a function taking one parameter, the BatchResult of each batch as it finishes.
+           If it raises, no more batches are sent, and the exception is raised once those in flight are done.
+        :param raise_on_error: True to raise the first batch's FusionError once all batches are done
+        :return: an IndexReport, in batch order, whose errors each carry the batch that caused them
+        """
+        pool = self.pool
+        if pool is None:
+            pool = WorkerPool(self.workers)
+        report = IndexReport()
+        report_lock = threading.Lock()
+        progress_errors = []
+
+        def finished(batch):
+            def callback(future):
+                try:
+                    if future.exception() is not None:
+                        result = BatchResult(batch, error=future.exception(), failed=[batch])
+                    else:
+                        result = future.result()
+                    with report_lock:
+                        report.add(result)
+                        if progress is not None:
+                            progress(result)
+                except Exception as e:
+                    progress_errors.append(e)
+                finally:
+                    self.__release(batch)
+
+            return callback
+
+        try:
+            batch_iter = iter(self.batches(docs))
+            while True:
+                # Wait for room before cutting the next batch, so its size reflects the latest results
+                self.__await_slot()
+                batch = next(batch_iter, None)
+                if batch is None or progress_errors:
+                    break
+                self.__acquire(batch)
+                pool.submit(self.send, batch).add_done_callback(finished(batch))
+            with self._condition:
+                while self._outstanding_batches > 0:
+                    self._condition.wait()
+        finally:
+            if self.pool is None:
+                pool.shutdown(wait=False)
+
+        report.finish()
+        if progress_errors:
+            raise progress_errors[0]
+        if raise_on_error and report.errors:
+            raise report.errors[0].error
+        return report
+
+
+class ParallelDeleter(ParallelIndexer):
+    """
+    Deletes documents in concurrent batches, by id or by query, reporting as ParallelIndexer does.
+    """
+
+    def __init__(self, collection, by="id", workers=4, batch_size=1000, **kwargs):
+        """
+        :param collection: the FusionCollection to delete from
+        :param by: "id" if the items to delete are document ids, "query" if they are queries
+        :param workers: the most batches to have in flight at once
+        :param batch_size: the most ids or queries to send in one request
+        :param kwargs: further parameters for ParallelIndexer, such as retry_policy
+        """
+        if by not in ["id", "query"]:
+            raise ValueError("Delete by id or by query")
+        super(ParallelDeleter, self).__init__(collection, workers=workers, batch_size=batch_size, **kwargs)
+        self.by = by
+
+    def send(self, batch):
+        return send_batch(self.collection, batch, retry_policy=self.retry_policy,
+                          send=lambda b: self.collection.delete_batch(b, by=self.by))
+
+
+class AdaptiveBatchController(object):
+    """
+    Chooses batch size and concurrency from observed results, by additive increase and multiplicative decrease:
+    each batch that comes back within the target time grows the next batch a little, and each error or slow batch
+    cuts batch size and concurrency by a factor.  Safe to share among threads.
+    """
+
+    def __init__(self, batch_size=100, min_batch_size=1, max_batch_size=10000, concurrency=1, max_concurrency=8,
+                 target_seconds=2.0, increase=50, decrease=0.5):
+        """
+        :param batch_size: the batch size to start with
+        :param min_batch_size: the smallest batch size to back off to
+        :param max_batch_size: the largest batch size to grow to
+        :param concurrency: the number of batches in flight to start with
+        :param max_concurrency: the most batches to have in flight
+        :param target_seconds: the round trip time above which a batch is taken as a sign of overload
+        :param increase: the number of documents to add to the batch size after each good batch
+        :param decrease: the factor to multiply batch size and concurrency by after a bad batch
+        """
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.target_seconds = target_seconds
+        self.increase = increase
+        self.decrease = decrease
+        self._lock = threading.Lock()
+        self._batch_size = float(min(max(batch_size, min_batch_size), max_batch_size))
+        self._concurrency = float(min(max(concurrency, 1), max_concurrency))
+        self.batches = 0
+        self.errors = 0
+        self.slow = 0
+        self.last_seconds = None
+
+    @property
+    def batch_size(self):
+        return int(self._batch_size)
+
+    @property
+    def concurrency(self):
+        return int(self._concurrency)
+
+    def observe(self, result):
+        """
+        Adjust batch size and concurrency according to the outcome of one batch.
+
+        :param result: a BatchResult
+        """
+        with self._lock:
+            self.batches += 1
+            self.last_seconds = result.seconds
+            if result.ok and result.seconds <= self.target_seconds:
+                self._batch_size = min(self._batch_size + self.increase, self.max_batch_size)
+                # grow concurrency by about one per round of batches
+                self._concurrency = min(self._concurrency + 1.0 / max(self._concurrency, 1), self.max_concurrency)
+            else:
+                if result.ok:
+                    self.slow += 1
+                else:
+                    self.errors += 1
+                self._batch_size = max(min(self._batch_size, len(result.batch)) * self.decrease, self.min_batch_size)
+                self._concurrency = max(self._concurrency * self.decrease, 1)
+
+    def state(self):
+        """
+        :return: a dict describing where the controller has settled
+        """
+        with self._lock:
+            return {"batchSize": self.batch_size,
+                    "concurrency": self.concurrency,
+                    "batches": self.batches,
+                    "errors": self.errors,
+                    "slow": self.slow,
+                    "lastSeconds": self.last_seconds}
+
+
+class AdaptiveIndexer(ParallelIndexer):
+    """
+    A ParallelIndexer whose batch size and concurrency follow an AdaptiveBatchController.
+    """
+
+    def __init__(self, collection, pipeline="default", controller=None, **kwargs):
+        """
+        :param controller: the AdaptiveBatchController to follow and inform, or None for a new one
+        :param kwargs: further parameters for ParallelIndexer.  workers is taken from the controller.
+        """
+        if controller is None:
+            controller = AdaptiveBatchController()
+        self.controller = controller
+        kwargs["workers"] = controller.max_concurrency
+        super(AdaptiveIndexer, self).__init__(collection, pipeline=pipeline, **kwargs)
+
+    def concurrency(self):
+        return self.controller.concurrency
+
+    def batches(self, docs):
+        return batches(docs, max_docs=lambda: self.controller.batch_size, max_bytes=self.batch_bytes,
+                       encode=self.encode)
+
+    def send(self, batch):
+        result = super(AdaptiveIndexer, self).send(batch)
+        self.controller.observe(result)
+        return result
+
+
+class CommitPolicy(object):
+    """
+    Decides when documents indexed through a FusionCollection are committed, so that many batches share one commit
+    and Solr doesn't open a new searcher for each.  Set one as a collection's commit_policy.  With no triggers
+    given, nothing is committed until the collection is flushed.  Safe to share among threads.
+    """
+
+    def __init__(self, every_docs=None, every_seconds=None, commit_within=None, clock=time.time):
+        """
+        :param every_docs: commit once at least this many documents are uncommitted
+        :param every_seconds: commit, at the next indexing request, once this long has passed since the last commit
+        :param commit_within: ask Solr to commit each indexing request within this many seconds, and leave
+           explicit commits for flush()
+        :param clock: the function telling the time
+        """
+        self.every_docs = every_docs
+        self.every_seconds = every_seconds
+        self.commit_within = commit_within
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.uncommitted = 0
+        self.requested = 0
+        self.commits = 0
+        self.coalesced = 0
+        self.last_commit = clock()
+
+    def __due(self):
+        if self.uncommitted == 0:
+            return False
+        if self.every_docs is not None and self.uncommitted >= self.every_docs:
+            return True
+        return self.every_seconds is not None and self.clock() - self.last_commit >= self.every_seconds
+
+    def __claim(self):
+        self.uncommitted = 0
+        self.requested = 0
+        self.commits += 1
+        self.last_commit = self.clock()
+        return True
+
+    def record(self, count):
+        """
+        Note documents written.
+        :return: True if the caller should commit now
+        """
+        with self._lock:
+            self.uncommitted += count
+            return self.__due() and self.__claim()
+
+    def request_commit(self):
+        """
+        Note an explicit request to commit.
+        :return: True if the caller should commit now, False if the request is coalesced into a later commit
+        """
+        with self._lock:
+            if self.__due():
+                return self.__claim()
+            self.requested += 1
+            self.coalesced += 1
+            return False
+
+    def flush(self):
+        """
+        :return: True if the caller should commit now, because something has not been committed
+        """
+        with self._lock:
+            if self.uncommitted > 0 or self.requested > 0:
+                return self.__claim()
+            return False
+
+
+JSONL_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def _parse_jsonl_chunk(chunk):
+    """
+    Check that each non-blank line of a run of JSON lines is a document, in a worker process.
+
+    :param chunk: a tuple of the file name, the offset of the chunk in the file, and the text of the chunk
+    :return: a list of the documents, as json strings
+    """
+    name, offset, text = chunk
+    docs = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            doc = jsoncodec.loads(line)
+        except ValueError as ve:
+            raise ValueError("%s near byte %d: %s" % (name, offset, ve))
+        if type(doc) is not dict:
+            raise ValueError("%s near byte %d: expected a document, found %s" % (name, offset, type(doc).__name__))
+        docs.append(line)
+    return docs
+
+
+def _parse_json_file(name):
+    """
+    :return: a list of the documents in a file holding one json array, as json strings
+    """
+    with _open(name) as fh:
+        return [jsoncodec.dumps(doc) for doc in jsoncodec.loads(fh.read())]
+
+
+def _open(name):
+    if name.endswith('.gz'):
+        return gzip.open(name, 'rb')
+    return open(name, 'rb')
+
+
+def _is_json_array(name):
+    with _open(name) as fh:
+        start = fh.read(64).lstrip()
+    return start.startswith('[')
+
+
+def _chunks(name, chunk_bytes):
+    """
+    Cut a JSON lines file into runs of whole lines.  Plain files are read through mmap, so slices come straight
+    from the page cache; gzipped files are decompressed a run of lines at a time.
+    """
+    if name.endswith('.gz'):
+        with gzip.open(name, 'rb') as fh:
+            offset = 0
+            while True:
+                text = fh.read(chunk_bytes)
+                if not text:
+                    return
+                text += fh.readline()
+                yield (name, offset, text)
+                offset += len(text)
+    if os.path.getsize(name) == 0:
+        return
+    with open(name, 'rb') as fh:
+        m = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            while start < len(m):
+                end = m.find('\n', min(start + chunk_bytes, len(m) - 1))
+                end = len(m) if end < 0 else end + 1
+                yield (name, start, m[start:end])
+                start = end
+        finally:
+            m.close()
+
+
+def _files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for f in sorted(files):
+                    if f.endswith(('.json', '.jsonl', '.json.gz', '.jsonl.gz')):
+                        yield os.path.join(root, f)
+        else:
+            yield path
+
+
+def read_json_docs(paths, processes=None, chunk_bytes=JSONL_CHUNK_BYTES):
+    """
+    Read documents from JSON lines files, optionally gzipped, parsing them across a pool of processes.  A file
+    whose content starts with "[" is read as a single json array instead.
+
+    :param paths: file names, or directories to search for .json, .jsonl, .json.gz, and .jsonl.gz files
+    :param processes: the number of parsing processes, defaulting to the number of CPUs
+    :param chunk_bytes: about how much of a file to hand each process at once
+    :return: a generator of documents as json strings, in file order, suitable for batches(..., encode=str)
+    """
+    pool = Pool(processes)
+    # Only a few chunks or whole files per process are read ahead, so memory doesn't grow with the size or the
+    # number of the files
+    window = 2 * (processes or cpu_count())
+    pending = deque()
+    try:
+        for name in _files(paths):
+            if _is_json_array(name):
+                tasks = [(_parse_json_file, name)]
+            else:
+                tasks = ((_parse_jsonl_chunk, chunk) for chunk in _chunks(name, chunk_bytes))
+            for parse, arg in tasks:
+                pending.append(pool.apply_async(parse, (arg,)))
+                if len(pending) >= window:
+                    for doc in pending.popleft().get():
+                        yield doc
+        while pending:
+            for doc in pending.popleft().get():
+                yield doc
+        pool.close()
+    finally:
+        pool.terminate()
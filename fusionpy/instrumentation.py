@@ -0,0 +1,252 @@
+import bisect
+import json
+import threading
+import time
+
+"""
+Contains hooks for timing requests to Fusion, and an aggregator of their timings into histograms
+"""
+
+# The segment following each of these names is a variable part of the path
+_VARIABLES = {"collections": "$collection", "index-pipelines": "$pipeline", "query-pipelines": "$pipeline",
+              "solr-config": "$file", "features": "$feature"}
+
+
+def path_template(path):
+    """
+    :param path: the path of a request, relative to /api/apollo/ or absolute
+    :return: the path with its query dropped and the names of collections, pipelines, config files and features
+       replaced by variables, like collections/$collection/stats, so that requests of one kind are counted together
+    """
+    path = path.split('?', 1)[0]
+    if path.startswith('/api/apollo/'):
+        path = path[12:]
+    segments = path.split('/')
+    for i in range(1, len(segments)):
+        variable = _VARIABLES.get(segments[i - 1])
+        if variable is None and i == 1 and segments[0] == "solr":
+            variable = "$collection"
+        if variable is not None and segments[i]:
+            segments[i] = variable
+    return '/'.join(segments)
+
+
+class RequestEvent(object):
+    """
+    What happened in one request, as passed to the hooks of an Instrumentation.  Before the request is sent, the
+    timings after serialize_seconds are 0 and status is None.  deserialize_seconds stays 0 until the caller decodes
+    the response body with jsoncodec.response_json, which is after the after hooks have run.
+    """
+    __slots__ = ('method', 'path', 'template', 'endpoint', 'status', 'bytes_out', 'bytes_in', 'serialize_seconds',
+                 'network_seconds', 'deserialize_seconds', 'retries', 'error', 'started', 'instrumentation')
+
+    def __init__(self, method, path, endpoint=None, instrumentation=None):
+        self.method = method
+        self.path = path
+        self.template = path_template(path)
+        self.endpoint = endpoint
+        self.status = None
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.serialize_seconds = 0.0
+        self.network_seconds = 0.0
+        self.deserialize_seconds = 0.0
+        self.retries = 0
+        self.error = None
+        self.started = time.time()
+        self.instrumentation = instrumentation
+
+    def deserialized(self, seconds):
+        """
+        Record the time the caller took to decode the response body, and call the decoded hooks.
+        """
+        self.deserialize_seconds += seconds
+        if self.instrumentation is not None:
+            self.instrumentation.decoded(self)
+
+    @property
+    def seconds(self):
+        return self.serialize_seconds + self.network_seconds + self.deserialize_seconds
+
+    def as_dict(self):
+        d = dict((name, getattr(self, name)) for name in self.__slots__ if name not in ('error', 'instrumentation'))
+        d['error'] = None if self.error is None else str(self.error)
+        return d
+
+    def __repr__(self):
+        return "RequestEvent(%s %s, status=%r, %.3fs, retries=%d)" % (self.method, self.template, self.status,
+                                                                     self.seconds, self.retries)
+
+
+class Instrumentation(object):
+    """
+    The hooks to call around each request of an HttpFusionRequester given this as its instrumentation.  A hook is a
+    function taking one parameter, the RequestEvent.  Hooks run in the thread making the request, so they should be
+    quick.  An exception from a hook is counted in hook_errors rather than failing the request.
+    """
+
+    def __init__(self, before=None, after=None, decoded=None):
+        """
+        :param before: hooks to call once the request body is serialized, before it is sent
+        :param after: hooks to call once the response has arrived, or the request has failed
+        :param decoded: hooks to call once the caller has decoded the response body, with deserialize_seconds set.
+           A response whose body isn't decoded, or isn't decoded by jsoncodec.response_json, doesn't get here.
+        """
+        self.before_hooks = list(before or [])
+        self.after_hooks = list(after or [])
+        self.decoded_hooks = list(decoded or [])
+        self.hook_errors = 0
+
+    def __call_hooks(self, hooks, event):
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception:
+                self.hook_errors += 1
+
+    def before(self, event):
+        self.__call_hooks(self.before_hooks, event)
+
+    def after(self, event):
+        self.__call_hooks(self.after_hooks, event)
+
+    def decoded(self, event):
+        self.__call_hooks(self.decoded_hooks, event)
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """
+    Counts of observations no greater than each bucket bound, along with their sum.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: a list of (bound, count of observations no greater than it), ending with (float('inf'), count)
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """
+        :return: the bound of the bucket holding the q quantile (0 < q <= 1), or None if nothing was observed
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+
+
+class RequestMetrics(object):
+    """
+    An after hook aggregating requests in memory by method, path template and status: a histogram of the
+    seconds each took, and totals of its parts, bytes and retries.  Its decoded method is the decoded hook adding
+    the time taken to decode responses to the deserialize_seconds totals; the histogram doesn't include it.  Dump
+    with as_dict, to_json or to_prometheus.
+
+        metrics = RequestMetrics()
+        requester = HttpFusionRequester(instrumentation=Instrumentation(after=[metrics], decoded=[metrics.decoded]))
+    """
+    TOTALS = ('serialize_seconds', 'network_seconds', 'deserialize_seconds', 'bytes_out', 'bytes_in', 'retries')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    @staticmethod
+    def __key(event):
+        return event.method, event.template, "error" if event.status is None else str(event.status)
+
+    def __call__(self, event):
+        key = self.__key(event)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = (Histogram(self.buckets), dict((t, 0) for t in self.TOTALS))
+            series[0].observe(event.seconds)
+            totals = series[1]
+            for t in self.TOTALS:
+                totals[t] += getattr(event, t)
+
+    def decoded(self, event):
+        with self._lock:
+            series = self._series.get(self.__key(event))
+            # None if reset since the response arrived
+            if series is not None:
+                series[1]['deserialize_seconds'] += event.deserialize_seconds
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def as_dict(self):
+        """
+        :return: a list with a dict for each method, path template and status
+        """
+        with self._lock:
+            result = []
+            for (method, template, status), (histogram, totals) in sorted(self._series.items()):
+                d = {"method": method, "path": template, "status": status, "count": histogram.count,
+                     "seconds": histogram.sum,
+                     "p50": histogram.quantile(0.5), "p90": histogram.quantile(0.9), "p99": histogram.quantile(0.99),
+                     "buckets": [[bound if bound != float('inf') else "+Inf", count]
+                                 for bound, count in histogram.cumulative()]}
+                for t in self.TOTALS:
+                    d[_camel(t)] = totals[t]
+                result.append(d)
+            return result
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def to_prometheus(self, prefix="fusionpy"):
+        """
+        :return: the metrics in the Prometheus text exposition format
+        """
+        lines = ["# HELP %s_request_seconds Seconds taken by requests to Fusion" % prefix,
+                 "# TYPE %s_request_seconds histogram" % prefix]
+        with self._lock:
+            series = sorted(self._series.items())
+            for (method, template, status), (histogram, totals) in series:
+                labels = 'method="%s",path="%s",status="%s"' % (method, _escape(template), status)
+                for bound, count in histogram.cumulative():
+                    le = "+Inf" if bound == float('inf') else repr(bound)
+                    lines.append('%s_request_seconds_bucket{%s,le="%s"} %d' % (prefix, labels, le, count))
+                lines.append('%s_request_seconds_sum{%s} %r' % (prefix, labels, histogram.sum))
+                lines.append('%s_request_seconds_count{%s} %d' % (prefix, labels, histogram.count))
+            for total in self.TOTALS:
+                name = "%s_request_%s_total" % (prefix, total)
+                lines.append("# TYPE %s counter" % name)
+                for (method, template, status), (histogram, totals) in series:
+                    lines.append('%s{method="%s",path="%s",status="%s"} %r' % (name, method, _escape(template), status,
+                                                                              totals[total]))
+        return "\n".join(lines) + "\n"
+
+
+def _camel(name):
+    first, rest = name.split('_', 1) if '_' in name else (name, '')
+    return first + ''.join(w.capitalize() for w in rest.split('_'))
+
+
+def _escape(label):
+    return label.replace('\\', '\\\\').replace('"', '\\"')
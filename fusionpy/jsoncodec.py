@@ -0,0 +1,97 @@
+import json
+import os
+import time
+
+"""
+Contains the json serialization used on hot paths, choosing the fastest codec installed, and falling back to the
+standard library's for what a faster codec can't handle
+"""
+
+BACKENDS = ['orjson', 'ujson', 'simplejson', 'json']
+
+
+def _codec(name):
+    """
+    :return: the (loads, dumps) pair for a codec, or None if it isn't installed
+    """
+    try:
+        if name == 'orjson':
+            import orjson
+            return orjson.loads, orjson.dumps
+        if name == 'ujson':
+            import ujson
+            return ujson.loads, lambda obj: ujson.dumps(obj, escape_forward_slashes=False)
+        if name == 'simplejson':
+            import simplejson
+            return simplejson.loads, simplejson.dumps
+    except ImportError:
+        return None
+    if name == 'json':
+        return json.loads, json.dumps
+    raise ValueError("Unknown json backend %s" % name)
+
+
+def _falling_back(fast, standard):
+    """
+    :return: a function calling fast, or standard if fast fails.  The faster codecs refuse some json the standard
+       library accepts, such as integers wider than 64 bits and NaN.
+    """
+    def call(arg):
+        try:
+            return fast(arg)
+        except (OverflowError, ValueError, TypeError):
+            return standard(arg)
+    return call
+
+
+def use(name=None):
+    """
+    Choose the codec.  Anything other than the standard library's falls back to it for values it can't encode or
+    decode, so that the choice doesn't change what can be sent or received.
+
+    :param name: one of BACKENDS, or None for the first of them that is installed
+    :return: the name of the codec in use
+    """
+    global loads, dumps, backend
+    for candidate in [name] if name is not None else BACKENDS:
+        codec = _codec(candidate)
+        if codec is not None:
+            loads, dumps = codec
+            if candidate != 'json':
+                loads, dumps = _falling_back(loads, json.loads), _falling_back(dumps, json.dumps)
+            backend = candidate
+            return backend
+    raise ImportError("json backend %s is not installed" % name)
+
+
+loads = json.loads
+dumps = json.dumps
+backend = 'json'
+use(os.environ.get('FUSIONPY_JSON_BACKEND'))
+
+
+def response_json(resp):
+    """
+    Decode the body of a response, only the first time it is asked for; later calls with the same response return
+    the same object, so treat it as read-only or copy it.  The decoding of an instrumented request's response is
+    timed, and passed to the decoded hooks of its instrumentation.
+
+    :param resp: an HTTP response, having attribute .data
+    :return: the decoded body
+    """
+    try:
+        return resp._fusionpy_json
+    except AttributeError:
+        pass
+    event = getattr(resp, '_fusionpy_event', None)
+    if event is not None:
+        started = time.time()
+        decoded = loads(resp.data)
+        event.deserialized(time.time() - started)
+    else:
+        decoded = loads(resp.data)
+    try:
+        resp._fusionpy_json = decoded
+    except AttributeError:
+        pass
+    return decoded
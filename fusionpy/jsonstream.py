@@ -0,0 +1,184 @@
+import codecs
+import json
+
+"""
+Contains an incremental parser for the array of documents in a large Solr response
+"""
+
+_WHITESPACE = ' \t\n\r'
+
+
+class DocsStreamParser(object):
+    """
+    Pulls the documents out of the array under a key (by default "docs") of a json response as the text arrives,
+    holding only about one document and one chunk in memory.  Everything before the array is skipped; everything
+    after it is ignored, unless the parser is asked to keep it.
+    """
+
+    def __init__(self, chunks, key="docs", outside=False):
+        """
+        :param chunks: an iterable of the response body in pieces, as bytes
+        :param key: the name of the member holding the array of documents
+        :param outside: True to keep the text before and after the array, for outside()
+        """
+        self.chunks = iter(chunks)
+        self.key = key
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = u''
+        self.pos = 0
+        self.exhausted = False
+        self.kept = [] if outside else None
+        self.keeping = outside
+        self.read_all = False
+
+    def __more(self):
+        """
+        Read another chunk into the buffer, discarding what has been consumed.
+        :return: False if there is nothing more to read
+        """
+        if self.exhausted:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.exhausted = True
+            chunk = ''
+        if self.keeping:
+            self.kept.append(self.buf[:self.pos])
+        self.buf = self.buf[self.pos:] + self.text_decoder.decode(chunk, final=self.exhausted)
+        self.pos = 0
+        return True
+
+    def __peek(self):
+        """
+        :return: the next character that isn't whitespace, without consuming it, or None at the end of the body
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.__more():
+                return None
+
+    def __seek_array(self):
+        """
+        Skip to just inside the array, following strings so that a key inside a value is not mistaken for it.
+        """
+        in_string = False
+        escaped = False
+        string_start = None
+        while True:
+            if self.pos >= len(self.buf):
+                if string_start is not None:
+                    # keep the string being scanned in the buffer
+                    offset = self.pos - string_start
+                    self.pos = string_start
+                    if not self.__more():
+                        raise ValueError("No \"%s\" array in the response" % self.key)
+                    string_start = 0
+                    self.pos = offset
+                elif not self.__more():
+                    raise ValueError("No \"%s\" array in the response" % self.key)
+                continue
+            c = self.buf[self.pos]
+            self.pos += 1
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif c == '\\':
+                    escaped = True
+                elif c == '"':
+                    in_string = False
+                    name = self.buf[string_start:self.pos - 1]
+                    string_start = None
+                    if name == self.key and self.__peek() == ':':
+                        self.pos += 1
+                        if self.__peek() == '[':
+                            self.pos += 1
+                            if self.keeping:
+                                self.kept.append(self.buf[:self.pos])
+                                self.keeping = False
+                            return
+            elif c == '"':
+                in_string = True
+                string_start = self.pos
+
+    def __keep_rest(self):
+        """
+        Keep the text from the end of the array to the end of the body.
+        """
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        self.keeping = True
+        while True:
+            self.pos = len(self.buf)
+            if not self.__more():
+                break
+        self.kept.append(self.buf)
+        self.pos = len(self.buf)
+        self.read_all = True
+
+    def outside(self):
+        """
+        Only available once the documents have all been read, and only when the parser was made with outside=True.
+
+        :return: the decoded response, with an empty array in place of the documents
+        """
+        if not self.read_all:
+            raise ValueError("The text outside the \"%s\" array wasn't kept, or the documents haven't all been read"
+                             % self.key)
+        return json.loads(u''.join(self.kept))
+
+    def __iter__(self):
+        self.__seek_array()
+        if self.__peek() == ']':
+            if self.kept is not None:
+                self.__keep_rest()
+            return
+        while True:
+            if self.__peek() is None:
+                raise ValueError("The response ended inside the \"%s\" array" % self.key)
+            try:
+                doc, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self.__more():
+                    raise
+                continue
+            if end == len(self.buf) and not self.exhausted:
+                # a number at the end of the buffer may continue in the next chunk
+                self.__more()
+                continue
+            self.pos = end
+            yield doc
+            c = self.__peek()
+            if c == ']':
+                if self.kept is not None:
+                    self.__keep_rest()
+                return
+            if c != ',':
+                raise ValueError("Expected , or ] after a document in the \"%s\" array, found %r" % (self.key, c))
+            self.pos += 1
+
+
+def iter_docs(chunks, key="docs", batch_size=None):
+    """
+    :param chunks: an iterable of the response body in pieces, as bytes
+    :param key: the name of the member holding the array of documents
+    :param batch_size: None to yield documents one at a time, or the number of documents to yield in each list
+    :return: a generator of documents, or of lists of documents
+    """
+    docs = DocsStreamParser(chunks, key=key)
+    if batch_size is None:
+        for doc in docs:
+            yield doc
+        return
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
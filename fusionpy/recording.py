@@ -0,0 +1,223 @@
+import gzip
+import hashlib
+import json
+import threading
+import time
+from base64 import b64decode, b64encode
+from collections import defaultdict
+from io import BytesIO
+from urllib import urlencode
+import urllib3
+from fusionpy import FusionError
+from fusionpy.connectors import FusionRequester, JsonArrayStream
+from fusionpy.workers import completed
+
+"""
+Contains requesters that record a session with Fusion to a file, and play it back without Fusion
+"""
+
+# Response headers worth keeping; the body is recorded decoded, so Content-Encoding and Content-Length are not
+RECORDED_HEADERS = ('Content-Type',)
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def request_key(method, path, fields=None, body=None):
+    """
+    :return: the (method, path, digest of fields and body) that a recorded request is found by on replay.  Dict
+       and list bodies are digested in a canonical encoding, so the json backend doesn't matter.  A JsonArrayStream
+       can't be read without consuming it, so only its presence counts.
+    """
+    digest = hashlib.sha1()
+    if fields:
+        digest.update(urlencode(sorted(fields.items()), True))
+    digest.update('\0')
+    if isinstance(body, JsonArrayStream):
+        digest.update('(stream)')
+    elif isinstance(body, (dict, list)):
+        digest.update(json.dumps(body, sort_keys=True, separators=(',', ':')))
+    elif isinstance(body, unicode):
+        digest.update(body.encode('utf-8'))
+    elif body is not None:
+        digest.update(body)
+    return method, path, digest.hexdigest()
+
+
+class RecordingFusionRequester(FusionRequester):
+    """
+    Passes requests on to another requester, writing each request and its response or error to a log, one json
+    line per exchange.  A log named *.gz is compressed.  Request bodies are kept only as a digest, so the log is
+    about the size of the responses.  Play the log back with ReplayFusionRequester:
+
+        requester = RecordingFusionRequester(HttpFusionRequester(), "session.jsonl.gz")
+        ... Fusion(requester) ...
+        requester.close()
+    """
+
+    def __init__(self, request_handler, path):
+        """
+        :param request_handler: the requester to record
+        :param path: the file to write the log to, replacing any already there
+        """
+        super(RecordingFusionRequester, self).__init__(request_handler)
+        self.path = path
+        self._out = _open(path, 'wb')
+        self._lock = threading.Lock()
+        self.recorded = 0
+
+    def __record(self, key, resp, error, seconds):
+        record = {"method": key[0], "path": key[1], "digest": key[2], "seconds": round(seconds, 6)}
+        if error is not None:
+            record["error"] = str(error)
+            record["unsent"] = error.unsent
+            resp = error.response if hasattr(error.response, 'status') else None
+        if resp is not None:
+            record["status"] = resp.status
+            record["headers"] = dict((h, resp.getheader(h)) for h in RECORDED_HEADERS if resp.getheader(h))
+            try:
+                record["body"] = resp.data.decode('utf-8')
+            except UnicodeDecodeError:
+                record["body64"] = b64encode(resp.data)
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._out.write(line)
+            self.recorded += 1
+
+    def __call(self, key, call, stream=False):
+        started = time.time()
+        try:
+            resp = call()
+        except FusionError as fe:
+            self.__record(key, None, fe, time.time() - started)
+            raise
+        if stream:
+            # Read the whole body for the log, and hand the caller a stream over the copy.  The body is read decoded,
+            # so the copy mustn't claim to be compressed, nor the length on the wire.
+            data = resp.read()
+            resp.release_conn()
+            headers = dict((h, v) for h, v in resp.headers.items()
+                           if h.lower() not in ('content-encoding', 'content-length'))
+            copy = urllib3.response.HTTPResponse(body=BytesIO(data), status=resp.status, headers=headers,
+                                                 preload_content=False)
+            self.__record(key, urllib3.response.HTTPResponse(body=data, status=resp.status, headers=headers),
+                          None, time.time() - started)
+            return copy
+        self.__record(key, resp, None, time.time() - started)
+        return resp
+
+    def request(self, method, path, headers=None, fields=None, body=None, validate=None):
+        return self.__call(request_key(method, path, fields, body),
+                           lambda: self.request_handler.request(method, path, headers, fields, body, validate))
+
+    def request_stream(self, method, path, headers=None, fields=None):
+        """
+        As the recorded requester's request_stream, except that the body is read in full before returning, and the
+        time recorded includes reading it.
+        """
+        return self.__call(request_key(method, path, fields),
+                           lambda: self.request_handler.request_stream(method, path, headers, fields), True)
+
+    def request_async(self, method, path, headers=None, fields=None, body=None, validate=None):
+        """
+        Like request, but on the recorded requester's worker_pool if it has one, so that requests overlap as they
+        would without recording.
+        """
+        worker_pool = getattr(self.request_handler, 'worker_pool', None)
+        if worker_pool is not None:
+            return worker_pool.submit(self.request, method, path, headers, fields, body, validate)
+        return completed(self.request, method, path, headers, fields, body, validate)
+
+    def close(self):
+        with self._lock:
+            self._out.close()
+        if hasattr(self.request_handler, 'close'):
+            self.request_handler.close()
+
+
+class ReplayFusionRequester(object):
+    """
+    Answers requests from a log written by RecordingFusionRequester, taking the recorded time for each, so that
+    client-side changes can be measured against a real session without Fusion.  A request is answered by the next
+    unused record of the same method, path, fields and body; failing that, of the same method and path, so that
+    indexing with a different batch size still replays.  Once the records for a request are used up, the last is
+    used again.  Safe to share among threads.
+    """
+
+    def __init__(self, path, latency_scale=1.0, fusion_url=None, sleep=time.sleep):
+        """
+        :param path: the log to replay
+        :param latency_scale: a factor for the recorded latencies: 0.5 replays twice as fast, 0 doesn't wait
+        :param fusion_url: the URL of the default collection to report, as for HttpFusionRequester.  Only its
+           last path segment is used.
+        :param sleep: the function to wait the latency with
+        """
+        self.latency_scale = latency_scale
+        self.sleep = sleep
+        self.default_collection = (fusion_url or 'http://localhost:8764/api/apollo/collections/replay') \
+            .split('?', 1)[0].rsplit('/', 1)[-1]
+        self._exact = defaultdict(list)
+        self._loose = defaultdict(list)
+        with _open(path, 'rb') as fh:
+            for line in fh:
+                record = json.loads(line)
+                self._exact[(record["method"], record["path"], record["digest"])].append(record)
+                self._loose[(record["method"], record["path"])].append(record)
+        self._used = defaultdict(int)
+        self._lock = threading.Lock()
+        self.replayed = 0
+        self.missed = 0
+
+    def get_admin_password(self):
+        return None
+
+    def get_default_collection(self):
+        return self.default_collection
+
+    def __next(self, key):
+        with self._lock:
+            for index, k in ((self._exact, key), (self._loose, key[0:2])):
+                records = index.get(k)
+                if records:
+                    used = self._used[k]
+                    self._used[k] = used + 1
+                    self.replayed += 1
+                    return records[min(used, len(records) - 1)]
+            self.missed += 1
+            return None
+
+    def __replay(self, key, body, validate, preload_content):
+        if isinstance(body, JsonArrayStream):
+            # Encode the documents, as sending them would
+            for _ in body:
+                pass
+        record = self.__next(key)
+        if record is None:
+            fe = FusionError(None, message="No recorded response to %s %s" % key[0:2])
+            fe.unsent = True
+            raise fe
+        if self.latency_scale:
+            self.sleep(record["seconds"] * self.latency_scale)
+        if "status" not in record:
+            fe = FusionError(None, message=record["error"])
+            fe.unsent = record["unsent"]
+            raise fe
+        data = b64decode(record["body64"]) if "body64" in record else record["body"].encode('utf-8')
+        resp = urllib3.response.HTTPResponse(body=BytesIO(data), status=record["status"], headers=record["headers"],
+                                             preload_content=preload_content)
+        if resp.status < 200 or resp.status > 299 or (validate is not None and not validate(resp)):
+            raise FusionError(resp, url=key[1])
+        return resp
+
+    def request(self, method, path, headers=None, fields=None, body=None, validate=None):
+        """
+        :return: the recorded response, as HttpFusionRequester.request would.  A recorded error is raised again as
+           a FusionError, as is a request that wasn't recorded.
+        """
+        return self.__replay(request_key(method, path, fields, body), body, validate, True)
+
+    def request_stream(self, method, path, headers=None, fields=None):
+        return self.__replay(request_key(method, path, fields), None, None, False)
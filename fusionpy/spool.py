@@ -0,0 +1,258 @@
+import json
+import os
+import re
+from fusionpy import jsoncodec
+from fusionpy.indexing import Batch, IndexReport, batches, send_batch, DEFAULT_BATCH_SIZE, DEFAULT_BATCH_BYTES
+
+"""
+Contains a write-ahead spool of index batches, so that an interrupted ingest can resume where Fusion left off
+"""
+
+SEGMENT_PATTERN = re.compile(r'^segment-(\d{8})\.spool$')
+
+DEAD_LETTER_FILE = "dead-letter.spool"
+
+
+class SpooledBatch(Batch):
+    """
+    A batch read back from a spool segment.  Its body is sent as it was written; its documents are only decoded
+    if the batch has to be split.
+    """
+
+    def __init__(self, number, count, body, segment, end):
+        """
+        :param number: the ordinal of this batch within the spool
+        :param count: the number of documents in the batch
+        :param body: the json array of the documents
+        :param segment: the number of the segment file the batch was read from
+        :param end: the offset in the segment just past the batch
+        """
+        self.number = number
+        self.count = count
+        self._body = body
+        self.nbytes = len(body)
+        self.offset = 0
+        self.segment = segment
+        self.end = end
+
+    @property
+    def encoded_docs(self):
+        return [jsoncodec.dumps(d) for d in jsoncodec.loads(self._body)]
+
+    def __len__(self):
+        return self.count
+
+    def body(self):
+        return self._body
+
+    def request_body(self):
+        # Already one string, as read from the segment
+        return self._body
+
+
+class Spooler(object):
+    """
+    Sends batches to an index pipeline by way of segment files in a directory.  Each batch is appended to the
+    current segment and flushed to disk before it is sent, and the position after it is recorded once Fusion
+    confirms writing it.  After a crash, a new Spooler on the same directory resumes from the last recorded
+    position, so only unconfirmed batches are sent again.  Segments are removed once all their batches are
+    confirmed.  With a retry_policy, documents Fusion rejects outright are moved to a dead-letter file in the same
+    directory, so that they don't hold up the rest of the spool.  A spool directory is for one process at a time.
+    """
+
+    def __init__(self, collection, directory, pipeline="default", segment_bytes=64 * 1024 * 1024, fsync=True,
+                 retry_policy=None):
+        """
+        :param collection: the FusionCollection to index into
+        :param directory: where to keep segment files and the acknowledgement record, created if need be
+        :param pipeline: the index pipeline to use
+        :param segment_bytes: the size at which to start a new segment file
+        :param fsync: True to force each batch and acknowledgement to disk, False to leave it to the OS
+        :param retry_policy: a connectors.RetryPolicy for retrying and splitting failed batches before giving up
+           on them, or None to give up at the first failure
+        """
+        self.collection = collection
+        self.directory = directory
+        self.pipeline = pipeline
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.retry_policy = retry_policy
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.acked_segment, self.acked_offset = self.__read_ack()
+        segments = self.segments()
+        self.segment = segments[-1] if segments else self.acked_segment
+        self.number = 0
+        self._out = None
+
+    def segments(self):
+        """
+        :return: the numbers of the segment files present, in order
+        """
+        return sorted(int(m.group(1)) for m in (SEGMENT_PATTERN.match(f) for f in os.listdir(self.directory)) if m)
+
+    def __segment_path(self, segment):
+        return os.path.join(self.directory, "segment-%08d.spool" % segment)
+
+    def dead_letter_path(self):
+        """
+        :return: the path of the file holding the documents Fusion rejected, in the same format as a segment
+        """
+        return os.path.join(self.directory, DEAD_LETTER_FILE)
+
+    def __ack_path(self):
+        return os.path.join(self.directory, "acked.json")
+
+    def __read_ack(self):
+        try:
+            with open(self.__ack_path()) as fh:
+                ack = json.load(fh)
+            return ack["segment"], ack["offset"]
+        except IOError:
+            return 0, 0
+
+    def __write_ack(self, segment, offset):
+        tmp = self.__ack_path() + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump({"segment": segment, "offset": offset}, fh)
+            fh.flush()
+            if self.fsync:
+                os.fsync(fh.fileno())
+        os.rename(tmp, self.__ack_path())
+        for s in self.segments():
+            if s < segment:
+                os.remove(self.__segment_path(s))
+        self.acked_segment, self.acked_offset = segment, offset
+
+    def __open_for_append(self):
+        path = self.__segment_path(self.segment)
+        self._out = open(path, "ab")
+        # Drop any partial record left by a crash while appending
+        end = self.__complete_length(path)
+        if end < self._out.tell():
+            self._out.truncate(end)
+            self._out.seek(end)
+
+    @staticmethod
+    def __complete_length(path):
+        length = 0
+        with open(path, "rb") as fh:
+            for line in fh:
+                if line.endswith("\n"):
+                    length += len(line)
+        return length
+
+    def append(self, batch):
+        """
+        Write a batch to the spool, durably, without sending it.
+        """
+        if self._out is None:
+            self.__open_for_append()
+        elif self._out.tell() >= self.segment_bytes:
+            self._out.close()
+            self.segment += 1
+            self.__open_for_append()
+        self._out.write("%d\t%s\n" % (len(batch), batch.body()))
+        self._out.flush()
+        if self.fsync:
+            os.fsync(self._out.fileno())
+
+    def __dead_letter(self, parts):
+        with open(self.dead_letter_path(), "ab") as fh:
+            for part in parts:
+                fh.write("%d\t%s\n" % (len(part), part.body()))
+            fh.flush()
+            if self.fsync:
+                os.fsync(fh.fileno())
+
+    def dead_letters(self):
+        """
+        :return: a generator of SpooledBatch, one for each part of a batch that Fusion rejected, usually a single
+           document
+        """
+        if not os.path.exists(self.dead_letter_path()):
+            return
+        with open(self.dead_letter_path(), "rb") as fh:
+            position = 0
+            for number, line in enumerate(fh):
+                if not line.endswith("\n"):
+                    break
+                position += len(line)
+                count, body = line[:-1].split("\t", 1)
+                yield SpooledBatch(number, int(count), body, None, position)
+
+    def pending(self):
+        """
+        :return: a generator of SpooledBatch not yet acknowledged, in the order they were appended
+        """
+        for segment in self.segments():
+            if segment < self.acked_segment:
+                continue
+            with open(self.__segment_path(segment), "rb") as fh:
+                if segment == self.acked_segment:
+                    fh.seek(self.acked_offset)
+                position = fh.tell()
+                while True:
+                    line = fh.readline()
+                    if not line.endswith("\n"):
+                        break
+                    position += len(line)
+                    count, body = line[:-1].split("\t", 1)
+                    yield SpooledBatch(self.number, int(count), body, segment, position)
+                    self.number += 1
+
+    def send(self, progress=None, report=None):
+        """
+        Send every batch in the spool that has not been acknowledged, acknowledging each once it is written.
+        With a retry_policy, the documents of a batch that Fusion rejected with a 4xx once the policy has isolated
+        them are appended to the dead-letter file, and the batch is acknowledged; its result in the report has the
+        error and lists them in failed.  Sending stops at any other batch that isn't completely written, so that it
+        is sent again, whole, by the next send or resume.
+
+        :param progress: if specified, a function taking one parameter, the indexing.BatchResult of each batch
+        :param report: an indexing.IndexReport to add results to, or None for a new one
+        :return: the indexing.IndexReport, or FusionError for a batch that was not completely written for any other
+           reason, leaving it in the spool
+        """
+        if report is None:
+            report = IndexReport()
+        for batch in self.pending():
+            result = send_batch(self.collection, batch, pipeline=self.pipeline, retry_policy=self.retry_policy)
+            if result.failed:
+                if not result.rejected:
+                    raise result.error
+                # Only the documents Fusion refused are left, and sending them again won't change its mind
+                self.__dead_letter(result.failed)
+            self.__write_ack(batch.segment, batch.end)
+            report.add(result)
+            if progress is not None:
+                progress(result)
+        return report
+
+    def resume(self, progress=None):
+        """
+        Send whatever an earlier, interrupted run left in the spool.
+        :return: an indexing.IndexReport
+        """
+        return self.send(progress=progress).finish()
+
+    def index(self, docs, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES, progress=None):
+        """
+        Index any iterable of documents by way of the spool, first sending anything left from an earlier run.
+
+        :param docs: an iterable or generator of dicts
+        :param batch_size: the most documents to send in one request
+        :param batch_bytes: the most serialized bytes to send in one request
+        :param progress: if specified, a function taking one parameter, the indexing.BatchResult of each batch
+        :return: an indexing.IndexReport
+        """
+        report = self.send(progress=progress)
+        for batch in batches(docs, max_docs=batch_size, max_bytes=batch_bytes):
+            self.append(batch)
+            self.send(progress=progress, report=report)
+        return report.finish()
+
+    def close(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
@@ -1,8 +1,11 @@
 __author__ = 'jscarbor'
 
 from fusionpy.fusion import Fusion
+from fusionpy.indexing import read_json_docs, DEFAULT_BATCH_SIZE
+import getopt
 import sys
 import json
+import time
 
 import errno
 import os
@@ -73,9 +76,90 @@ def dir(args):
     }, indent=True, separators=(',', ':'), sort_keys=True)
 
 
+def index(args):
+    """
+    Index documents from JSON lines files (optionally gzipped), or directories of them, then commit.
+    Files are parsed by a pool of processes and sent by several concurrent batches.
+
+    :param args: [--pipeline name] [--batch-size n] [--workers n] [--parsers n] [--collection name] [--no-commit]
+       followed by the files or directories to index
+    """
+    opts, paths = getopt.getopt(args, "", ["pipeline=", "batch-size=", "workers=", "parsers=", "collection=",
+                                           "no-commit"])
+    opts = dict(opts)
+    if len(paths) == 0:
+        print "Name at least one file or directory to index."
+        sys.exit(2)
+
+    collection = Fusion().get_collection(opts.get("--collection"))
+    parsers = opts.get("--parsers")
+    start = time.time()
+    totals = {"docs": 0, "bytes": 0}
+
+    def progress(result):
+        totals["docs"] += len(result.batch)
+        totals["bytes"] += result.batch.nbytes
+        elapsed = max(time.time() - start, 0.001)
+        sys.stderr.write("\r%d docs, %.0f docs/s, %.0f bytes/s " %
+                         (totals["docs"], totals["docs"] / elapsed, totals["bytes"] / elapsed))
+
+    report = collection.index_parallel(read_json_docs(paths, processes=parsers and int(parsers)),
+                                       pipeline=opts.get("--pipeline", "default"),
+                                       workers=int(opts.get("--workers", 4)),
+                                       batch_size=int(opts.get("--batch-size", DEFAULT_BATCH_SIZE)),
+                                       encode=str,
+                                       progress=progress)
+    sys.stderr.write("\n")
+    if "--no-commit" not in opts:
+        collection.commit()
+
+    elapsed = max(report.seconds, 0.001)
+    print "Indexed %d of %d documents (%d bytes) in %.1fs: %.0f docs/s, %.0f bytes/s" % (
+        report.written, report.docs, report.bytes, elapsed, report.docs / elapsed, report.bytes / elapsed)
+    if report.errors:
+        for r in report.errors:
+            print "Batch %d failed: %s" % (r.batch.number, r.error)
+        sys.exit(1)
+
+
+def fake(args):
+    """
+    Serve a fake Fusion, keeping everything in memory, until interrupted.  Prints its collection URL for
+    FUSION_API_COLLECTION_URL.
+
+    :param args: [--port n] [--latency seconds] [--error-rate fraction] [--collection name]
+    """
+    from fusionpy.fakefusion import FakeFusion, FakeFusionServer
+
+    opts, _ = getopt.getopt(args, "", ["port=", "latency=", "error-rate=", "collection="])
+    opts = dict(opts)
+    collection = opts.get("--collection", "phi")
+    server = FakeFusionServer(port=int(opts.get("--port", 8764)), fusion=FakeFusion(collections=(collection,)),
+                              latency=float(opts.get("--latency", 0)),
+                              error_rate=float(opts.get("--error-rate", 0)))
+    print server.collection_url(collection)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
 def print_help(args):
     print "Usage"
     print "  python -m fusionpy.tool <verb> [argument] [...]"
+    print
+    print "Verbs"
+    print "  configure <file>     create collections from a configuration file, or check them against it"
+    print "  delete [collection]  delete a collection if it exists"
+    print "  dir                  list the collections and pipelines available for export"
+    print "  export <file>        save the configuration of the things listed in a file"
+    print "  index [--pipeline name] [--batch-size n] [--workers n] [--parsers n] [--collection name] [--no-commit]"
+    print "        <file or directory> [...]"
+    print "                       index JSON lines or JSON array files, optionally gzipped, then commit"
+    print "  fake [--port n] [--latency seconds] [--error-rate fraction] [--collection name]"
+    print "                       serve a fake Fusion in memory until interrupted"
+    print "  help                 print this message"
 
 
 def __ascii_keys(athing):
@@ -0,0 +1,189 @@
+import threading
+from Queue import Queue
+
+"""
+Contains a small thread pool and futures for running requests concurrently over a shared connection pool
+"""
+
+
+class Future(object):
+    """
+    The eventual result of a call submitted to a WorkerPool.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self.callback_errors = 0
+
+    def done(self):
+        return self._done
+
+    def set_result(self, result):
+        self.__finish(result, None)
+
+    def set_exception(self, exception):
+        self.__finish(None, exception)
+
+    def __finish(self, result, exception):
+        with self._condition:
+            self._result = result
+            self._exception = exception
+            self._done = True
+            self._condition.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            self.__call(cb)
+
+    def __call(self, callback):
+        # A failing callback mustn't stop the others, nor kill the worker thread finishing this future
+        try:
+            callback(self)
+        except Exception:
+            self.callback_errors += 1
+
+    def __wait(self, timeout):
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise RuntimeError("Timed out waiting for result")
+
+    def exception(self, timeout=None):
+        """
+        :param timeout: seconds to wait, or None to wait indefinitely
+        :return: the exception raised by the call, or None if it succeeded
+        """
+        self.__wait(timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        """
+        :param timeout: seconds to wait, or None to wait indefinitely
+        :return: the value returned by the call, or the exception it raised
+        """
+        self.__wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_done_callback(self, fn):
+        """
+        :param fn: a function taking one parameter, this future, called once it is done
+        """
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        self.__call(fn)
+
+    def then(self, fn, on_error=None):
+        """
+        Chain a transformation onto this future.
+
+        :param fn: a function taking the result of this future and returning the result of the new one
+        :param on_error: if specified, a function taking the exception of this future, which may raise another
+           exception in its place or return a result to recover
+        :return: a Future for the transformed result
+        """
+        chained = Future()
+
+        def callback(f):
+            try:
+                if f._exception is None:
+                    chained.set_result(fn(f._result))
+                elif on_error is not None:
+                    chained.set_result(on_error(f._exception))
+                else:
+                    chained.set_exception(f._exception)
+            except Exception as e:
+                chained.set_exception(e)
+
+        self.add_done_callback(callback)
+        return chained
+
+
+def completed(fn, *args, **kwargs):
+    """
+    Call fn right away, in this thread.
+
+    :return: a Future which is already done with the result or exception of fn(*args, **kwargs)
+    """
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+class WorkerPool(object):
+    """
+    A fixed set of daemon threads running submitted calls.  Requesters are safe to share among them, since
+    urllib3's PoolManager is thread safe.
+    """
+
+    def __init__(self, workers=4):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        self.workers = workers
+        self._queue = Queue()
+        self._threads = []
+        for i in range(0, workers):
+            t = threading.Thread(target=self.__work, name="fusionpy-worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def __work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        :return: a Future for the result of fn(*args, **kwargs)
+        """
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers once the calls already submitted are finished.
+        """
+        for t in self._threads:
+            self._queue.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+def as_completed(futures):
+    """
+    :param futures: an iterable of Future
+    :return: a generator of the futures, in the order they finish
+    """
+    futures = list(futures)
+    finished = Queue()
+    for f in futures:
+        f.add_done_callback(finished.put)
+    for i in range(0, len(futures)):
+        yield finished.get()
@@ -12,6 +12,7 @@ config = {
     'author_email': 'jscarbor@redhat.com',
     'version': '0.1',
     'install_requires': ['nose', 'tqdm', 'urllib3'],
+    'extras_require': {'columns': ['numpy']},
     'build_requires': ['stubserver'],
     'packages': ['fusionpy'],
     'scripts': [],